@@ -0,0 +1,179 @@
+# -*-*- encoding: utf-8 -*-*-
+"""
+End-to-end crawler benchmark. Crawls a generated site served by a local stub server into
+a fresh SQLite database and reports throughput, memory use, transferred bytes, database
+writes and the time spent per stage. Results are appended to benchmarks/results.jsonl,
+together with the last result of the same scenario for comparison.
+
+    python -m benchmarks.run --urls 100000 --latency 20
+"""
+from __future__ import absolute_import
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+from datetime import datetime
+from time import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl')
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description='Benchmarks a crawl of a generated site.')
+    p.add_argument('--urls', type=int, default=10000, help='number of pages on the site')
+    p.add_argument('--per-sitemap', type=int, default=5000, help='urls per sitemap')
+    p.add_argument('--fanout', type=int, default=10, help='sitemaps per nested sitemap index')
+    p.add_argument('--page-size', type=int, default=10000, help='approximate page size in bytes')
+    p.add_argument('--latency', type=float, default=0, help='response time of pages in milliseconds')
+    p.add_argument('--no-gzip', dest='gzipped', action='store_false', help='serve uncompressed sitemaps')
+    p.add_argument('--head', action='store_true', help='only extract from the html head')
+    p.add_argument('--engine', default='gevent', help='crawl engine, see screep.engines')
+    p.add_argument('--workers', type=int, default=50, help='MAXWORKERS')
+    p.add_argument('--extract-workers', type=int, default=0, help='EXTRACTWORKERS')
+    p.add_argument('--rate', type=float, default=0, help='REQUESTRATE, 0 for no limit')
+    p.add_argument('--output', default=RESULTS, help='file to append the result to')
+    p.add_argument('--no-save', dest='save', action='store_false', help='do not store the result')
+    return p.parse_args(argv)
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--tags', '--always', '--dirty'],
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+def setup_database(args, host):
+    from django.core.management import call_command
+    from screep.models import CrawlConfig, CrawlDomain, DomainAttributes
+
+    call_command('migrate', verbosity=0, interactive=False)
+    config = {
+        'USERAGENT': 'ScreepBenchmark/1.0',
+        'REQUESTRATE': args.rate,
+        'MAXWORKERS': args.workers,
+        'POOLSIZE': args.workers,
+        'EXTRACTWORKERS': args.extract_workers,
+    }
+    for key, value in config.iteritems():
+        CrawlConfig.objects.create(key=key, value=str(value))
+    domain = CrawlDomain.objects.create(name='benchmark', domain=host)
+    if args.head:
+        DomainAttributes.objects.create(domain=domain, key='title', xpath='//head/title/text()')
+    else:
+        DomainAttributes.objects.create(domain=domain, key='title', xpath='//body/h1/text()')
+    return domain
+
+
+def run(args):
+    from benchmarks.server import Site, StubServer
+
+    db = None
+    site = Site(urls=args.urls, per_sitemap=args.per_sitemap, fanout=args.fanout, page_size=args.page_size,
+                latency=args.latency / 1000.0, gzipped=args.gzipped)
+    # start serving before anything gets monkey patched
+    server = StubServer(site)
+    server.start()
+    try:
+        import django
+        from django.conf import settings
+        django.setup()
+        db = settings.DATABASES['default']['NAME']
+        if os.path.exists(db):
+            os.remove(db)
+
+        from screep.engines import get_engine
+        from screep.tasks import CrawlerTask
+        from screep.tests.models import ScrapedItem
+        domain = setup_database(args, server.host)
+        crawler = CrawlerTask(domain, ScrapedItem, force=True, engine=get_engine(args.engine))
+        start = time()
+        crawler.start()
+        elapsed = time() - start
+        scraped = ScrapedItem.objects.count()
+        counters, histograms = crawler.metrics.counters, crawler.metrics.histograms
+        # stage times add up over all downloads and batches, so they can exceed the crawl time
+        stages = dict((stage, round(h.total / 1000, 3)) for stage, h in histograms.iteritems())
+        rows = counters.get('db.rows', 0)
+        metrics = {
+            'seconds': round(elapsed, 3),
+            'urls': scraped,
+            'urls_per_sec': round(scraped / elapsed, 1),
+            'downloads': histograms['fetch'].count if 'fetch' in histograms else 0,
+            'peak_rss_mb': peak_rss_mb(),
+            'bytes_transferred': server.bytes_sent,
+            'db_rows': rows,
+            'db_rows_per_sec': round(rows / stages['consolidate'], 1) if stages.get('consolidate') else None,
+            'stages': stages,
+            'fetch_p95_ms': histograms['fetch'].percentile(95) if 'fetch' in histograms else None,
+            'errors': sum(v for k, v in counters.iteritems() if k.startswith('errors.')),
+        }
+    finally:
+        server.stop()
+        if db is not None and os.path.exists(db):
+            os.remove(db)
+    scenario = dict((k, v) for k, v in vars(args).iteritems() if k not in ('output', 'save'))
+    return {
+        'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'revision': revision(),
+        'python': sys.version.split()[0],
+        'scenario': scenario,
+        'metrics': metrics,
+    }
+
+
+def previous(path, scenario):
+    """
+    Returns the last stored result for given scenario, if any.
+    """
+    last = None
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    if result['scenario'] == scenario:
+                        last = result
+    return last
+
+
+def report(result, last=None):
+    m = result['metrics']
+    print "revision:           {0}".format(result['revision'])
+    print "urls scraped:       {0} in {1}s".format(m['urls'], m['seconds'])
+    print "urls/sec:           {0}".format(m['urls_per_sec'])
+    print "peak rss:           {0} MB".format(m['peak_rss_mb'])
+    print "bytes transferred:  {0}".format(m['bytes_transferred'])
+    print "db rows/sec:        {0} ({1} rows)".format(m['db_rows_per_sec'], m['db_rows'])
+    for stage in ('robots', 'sitemap', 'queue_wait', 'fetch', 'parse', 'consolidate'):
+        print "{0:20}{1}s".format(stage + ':', m['stages'].get(stage, 0))
+    if last is not None:
+        lm = last['metrics']
+        change = 100.0 * (m['urls_per_sec'] - lm['urls_per_sec']) / lm['urls_per_sec'] if lm['urls_per_sec'] else 0
+        print "previous:           {0} urls/sec, {1} MB at {2} ({3:+.1f}%)".format(
+            lm['urls_per_sec'], lm['peak_rss_mb'], last['revision'], change)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run(args)
+    last = previous(args.output, result['scenario'])
+    report(result, last)
+    if args.save:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# -*-*- encoding: utf-8 -*-*-
+"""
+Stub web site for benchmarks. Serves a robots.txt that points to a sitemap index, which
+lists nested sitemap indexes, which list (optionally gzipped) sitemaps of generated pages:
+
+    /robots.txt
+    /sitemap.xml                    index of /sitemaps/index-<i>.xml
+    /sitemaps/index-<i>.xml         index of up to `fanout` sitemaps
+    /sitemaps/urls-<j>.xml[.gz]     urlset of up to `per_sitemap` pages
+    /pages/<k>                      html page of about `page_size` bytes
+
+Everything is generated on request, so sites with a million urls need no setup.
+"""
+import gzip
+import io
+import multiprocessing
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+PAGE = """<html><head><title>Page {0}</title><meta name="description" content="Description of page {0}"></head>
+<body><h1>Page {0}</h1>{1}</body></html>"""
+PARAGRAPH = '<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt.</p>\n'
+
+
+class Site(object):
+    """
+    Generates the content of the stub site.
+    """
+
+    def __init__(self, urls=10000, per_sitemap=5000, fanout=10, page_size=10000, latency=0.0, gzipped=True):
+        self.urls = urls
+        self.per_sitemap = per_sitemap
+        self.fanout = fanout
+        self.page_size = page_size
+        self.latency = latency
+        self.gzipped = gzipped
+        self.host = None
+        self.sitemaps = (urls + per_sitemap - 1) // per_sitemap
+        self.indexes = (self.sitemaps + fanout - 1) // fanout
+
+    def url(self, path):
+        return 'http://{0}{1}'.format(self.host, path)
+
+    def sitemap_path(self, j):
+        return '/sitemaps/urls-{0}.xml{1}'.format(j, '.gz' if self.gzipped else '')
+
+    def robots(self):
+        return 'User-agent: *\nDisallow: /private\nSitemap: {0}\n'.format(self.url('/sitemap.xml'))
+
+    def sitemap_index(self, paths):
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="{0}">{1}</sitemapindex>'.format(
+            SITEMAP_NS, ''.join('<sitemap><loc>{0}</loc></sitemap>'.format(self.url(p)) for p in paths))
+
+    def root_index(self):
+        return self.sitemap_index('/sitemaps/index-{0}.xml'.format(i) for i in xrange(self.indexes))
+
+    def nested_index(self, i):
+        first = i * self.fanout
+        return self.sitemap_index(self.sitemap_path(j) for j in xrange(first, min(first + self.fanout, self.sitemaps)))
+
+    def urlset(self, j):
+        first = j * self.per_sitemap
+        entries = ''.join('<url><loc>{0}</loc><lastmod>2015-01-01</lastmod></url>\n'.format(self.url('/pages/%d' % k))
+                          for k in xrange(first, min(first + self.per_sitemap, self.urls)))
+        content = '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{0}">{1}</urlset>'.format(SITEMAP_NS, entries)
+        if not self.gzipped:
+            return content
+        buf = io.BytesIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6)
+        f.write(content)
+        f.close()
+        return buf.getvalue()
+
+    def page(self, k):
+        return PAGE.format(k, PARAGRAPH * max(0, self.page_size // len(PARAGRAPH)))
+
+    def get(self, path):
+        """
+        Returns content type and content for given path, or None if there is no such page.
+        """
+        try:
+            if path == '/robots.txt':
+                return 'text/plain', self.robots()
+            if path == '/sitemap.xml':
+                return 'text/xml', self.root_index()
+            if path.startswith('/sitemaps/index-'):
+                return 'text/xml', self.nested_index(int(path[16:-4]))
+            if path.startswith('/sitemaps/urls-'):
+                return 'application/octet-stream' if self.gzipped else 'text/xml', self.urlset(int(path[15:].split('.')[0]))
+            if path.startswith('/pages/'):
+                if self.latency > 0:
+                    time.sleep(self.latency)
+                return 'text/html; charset=utf-8', self.page(int(path[7:]))
+        except ValueError:
+            pass
+        return None
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        result = self.server.site.get(self.path)
+        if result is None:
+            self.send_error(404)
+            return
+        content_type, content = result
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        with self.server.sent.get_lock():
+            self.server.sent.value += len(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class StubServer(object):
+    """
+    Runs the stub site in a separate process, so serving it does not compete with the
+    crawler for the interpreter lock. Counts the bytes of content sent.
+    """
+
+    def __init__(self, site):
+        self.site = site
+        self.sent = multiprocessing.Value('L', 0)
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.site = site
+        self.server.sent = self.sent
+        site.host = '127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.process = None
+
+    @property
+    def host(self):
+        return self.site.host
+
+    @property
+    def bytes_sent(self):
+        return self.sent.value
+
+    def start(self):
+        self.process = multiprocessing.Process(target=self.server.serve_forever)
+        self.process.daemon = True
+        self.process.start()
+        self.server.socket.close()  # the child process has its own copy
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
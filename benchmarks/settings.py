@@ -0,0 +1,32 @@
+# -*-*- encoding: utf-8 -*-*-
+import os
+import tempfile
+
+DEBUG = False
+TIME_ZONE = 'UTC'
+USE_TZ = True
+SECRET_KEY = 'benchmark'
+MIDDLEWARE_CLASSES = ()
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('SCREEP_BENCHMARK_DB', os.path.join(tempfile.gettempdir(), 'screep_benchmark.sqlite3')),
+    }
+}
+
+INSTALLED_APPS = (
+    'django.contrib.contenttypes',
+    'screep',
+    'screep.tests',
+)
+
+SCREEP_TARGET_MODEL = 'tests.ScrapedItem'
+SCREEP_METRICS = 'null'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {'console': {'class': 'logging.StreamHandler'}},
+    'loggers': {'apps': {'handlers': ['console'], 'level': 'ERROR'}},
+}
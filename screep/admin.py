@@ -1,6 +1,6 @@
 # -*-*- encoding: utf-8 -*-*-
 from django.contrib import admin
-from .models import CrawlConfig, CrawlDomain, DomainAttributes
+from .models import CrawlCheckpoint, CrawlChunk, CrawlConfig, CrawlDomain, DomainAttributes
 
 
 class CrawlConfigAdmin(admin.ModelAdmin):
@@ -16,9 +16,20 @@ class DomainAttributesInline(admin.TabularInline):
 
 class CrawlDomainAdmin(admin.ModelAdmin):
     list_display = ['name', 'domain']
-    list_filter = ['status']
+    list_filter = ['status', 'fullcrawl']
     inlines = (DomainAttributesInline,)
 
 
+class CrawlCheckpointAdmin(admin.ModelAdmin):
+    list_display = ['domain', 'started', 'updated']
+
+
+class CrawlChunkAdmin(admin.ModelAdmin):
+    list_display = ['domain', 'status', 'claimed']
+    list_filter = ['status']
+
+
+admin.site.register(CrawlCheckpoint, CrawlCheckpointAdmin)
+admin.site.register(CrawlChunk, CrawlChunkAdmin)
 admin.site.register(CrawlConfig, CrawlConfigAdmin)
 admin.site.register(CrawlDomain, CrawlDomainAdmin)
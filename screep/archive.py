@@ -0,0 +1,355 @@
+# -*-*- encoding: utf-8 -*-*-
+import fcntl
+import hashlib
+import mmap
+import os
+import re
+import socket
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from time import time
+from django.conf import settings
+from .exceptions import CrawlerException
+
+
+# record header: url length, encoding length, compressed body length
+HEADER = struct.Struct('<HHI')
+# index entry: first 8 bytes of the md5 of the url, segment number, offset in the segment, time archived
+ENTRY = struct.Struct('<8sIQd')
+
+
+def url_key(url):
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return hashlib.md5(url).digest()[:8]
+
+
+class PageArchive(object):
+    """
+    Raw page bodies of one domain, zlib compressed and appended to segment files of about
+    `segment_size` bytes. An index file maps each url to the segment and offset of its
+    record. A url archived again is appended again, the latest copy wins.
+
+    Several processes may archive pages of a domain at the same time, such as the shards of
+    a crawl, so every process writes files of its own, named after its host and pid:
+
+        <root>/<domain>/<writer>.00000.seg  records: header, url, encoding, compressed body
+        <root>/<domain>/<writer>.idx        fixed size entries, one per record, as appended
+
+    compact() merges them into one writer that holds only the latest record of every url,
+    with its entries sorted by url key, so that they are found by binary search:
+
+        <root>/<domain>/<writer>.sorted     fixed size entries, one per url
+
+    Writers and readers hold a shared lock on <root>/<domain>/lock, compaction an exclusive one.
+    """
+
+    SEGMENT = re.compile(r'^(.+)\.(\d+)\.seg$')
+
+    def __init__(self, root, domain, segment_size=256 * 1024 * 1024):
+        self.path = os.path.join(root, re.sub(r'[^\w.-]', '_', domain))
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.pid = None
+        self.writer = None
+        self.segment = 0
+        self.file = None
+        self.index = None
+        self.lockfile = None
+
+    def segments(self):
+        """
+        Returns the segments in the archive, as sorted tuples of writer and segment number.
+        """
+        segments = []
+        for name in os.listdir(self.path):
+            m = PageArchive.SEGMENT.match(name)
+            if m is not None:
+                segments.append((m.group(1), int(m.group(2))))
+        return sorted(segments)
+
+    def writers(self, extension='.idx'):
+        return sorted(name[:-len(extension)] for name in os.listdir(self.path) if name.endswith(extension))
+
+    def segment_path(self, writer, segment):
+        return os.path.join(self.path, '%s.%05d.seg' % (writer, segment))
+
+    def index_path(self, writer, extension='.idx'):
+        return os.path.join(self.path, writer + extension)
+
+    def flock(self, exclusive=False, blocking=True):
+        """
+        Returns an open file holding a lock on the archive, or None if `blocking` is off and
+        the lock is taken. The lock is released when the file is closed.
+        """
+        f = open(os.path.join(self.path, 'lock'), 'a')
+        try:
+            fcntl.flock(f.fileno(), (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB))
+        except IOError:
+            f.close()
+            if blocking:
+                raise
+            return None
+        return f
+
+    @contextmanager
+    def reading(self):
+        # compaction removes the files it merged
+        f = self.flock()
+        try:
+            yield
+        finally:
+            f.close()
+
+    def _open(self):
+        # unbuffered, so every record goes out in one write and a forked child inherits no
+        # buffered data. The files of a parent are left alone, it still writes to them.
+        self.pid = os.getpid()
+        self.lockfile = self.flock()
+        self.writer = '%s-%d' % (re.sub(r'[^\w-]', '_', socket.gethostname()), self.pid)
+        segments = [n for w, n in self.segments() if w == self.writer]
+        self.segment = segments[-1] if segments else 0
+        self.file = open(self.segment_path(self.writer, self.segment), 'ab', 0)
+        self.file.seek(0, os.SEEK_END)  # where tell() starts in append mode varies
+        self.index = open(self.index_path(self.writer), 'ab', 0)
+        self.index.seek(0, os.SEEK_END)
+        size = self.index.tell()
+        if size % ENTRY.size:
+            self.index.truncate(size - size % ENTRY.size)  # the last entry was cut off
+
+    def append(self, url, content, encoding=None):
+        """
+        Archives the body of given url. Safe to call from concurrent downloads and processes.
+        """
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        encoding = encoding or ''
+        body = zlib.compress(content, 6)
+        record = HEADER.pack(len(url), len(encoding), len(body)) + url + encoding + body
+        with self.lock:
+            if self.file is None or self.pid != os.getpid():
+                self._open()
+            offset = self.file.tell()
+            if offset > 0 and offset + len(record) > self.segment_size:
+                self.file.close()
+                self.segment += 1
+                self.file = open(self.segment_path(self.writer, self.segment), 'ab', 0)
+                offset = 0
+            self.file.write(record)
+            self.index.write(ENTRY.pack(url_key(url), self.segment, offset, time()))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None and self.pid == os.getpid():
+                self.file.close()
+                self.index.close()
+                self.lockfile.close()
+            self.file = self.index = self.lockfile = None
+
+    def index_files(self):
+        """
+        Returns the index files in the archive, as tuples of writer, path and whether the
+        entries are sorted.
+        """
+        files = [(w, self.index_path(w, '.sorted'), True) for w in self.writers('.sorted')]
+        return files + [(w, self.index_path(w), False) for w in self.writers()]
+
+    def entries(self):
+        """
+        Iterates over the index entries of all writers, as tuples of key, writer, segment,
+        offset and time archived.
+        """
+        for writer, path, ordered in self.index_files():
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < ENTRY.size:
+                    continue
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for pos in xrange(0, len(index) - ENTRY.size + 1, ENTRY.size):
+                        key, segment, offset, archived = ENTRY.unpack_from(index, pos)
+                        yield key, writer, segment, offset, archived
+                finally:
+                    index.close()
+
+    def read(self, f, offset):
+        """
+        Reads the record at given offset of an open segment. Returns url, encoding and the
+        compressed body, which is cut short if the record is. Raises CrawlerException if
+        not even the header can be read.
+        """
+        f.seek(offset)
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise CrawlerException(message="Truncated record at {0} of {1}".format(offset, f.name))
+        url_length, encoding_length, body_length = HEADER.unpack(header)
+        url = f.read(url_length)
+        encoding = f.read(encoding_length) or None
+        return url, encoding, f.read(body_length)
+
+    @staticmethod
+    def search_sorted(index, key):
+        """
+        Yields the position of the entry for given key in a sorted index, if there is one.
+        """
+        lo, hi = 0, len(index) // ENTRY.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if index[mid * ENTRY.size:mid * ENTRY.size + len(key)] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        pos = lo * ENTRY.size
+        if pos + ENTRY.size <= len(index) and index[pos:pos + len(key)] == key:
+            yield pos
+
+    @staticmethod
+    def search_appended(index, key):
+        """
+        Yields the positions of the entries for given key in an appended index, latest first.
+        """
+        end = len(index)
+        while True:
+            pos = index.rfind(key, 0, end)
+            if pos < 0:
+                return
+            end = pos + len(key) - 1
+            if pos % ENTRY.size == 0 and pos + ENTRY.size <= len(index):
+                yield pos  # else matched across entries
+
+    def get(self, url):
+        """
+        Returns the latest archived body of given url and its encoding, or None. Looks the url
+        up by binary search in the compacted index, and by scanning what was appended since.
+        """
+        key = url_key(url)
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        found = None
+        with self.reading():
+            for writer, path, ordered in self.index_files():
+                with open(path, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size < ENTRY.size:
+                        continue
+                    index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        search = self.search_sorted if ordered else self.search_appended
+                        for pos in search(index, key):
+                            _, segment, offset, archived = ENTRY.unpack_from(index, pos)
+                            if found is not None and found[0] >= archived:
+                                break
+                            with open(self.segment_path(writer, segment), 'rb') as s:
+                                record = self.read(s, offset)
+                            if record[0] == url:
+                                found = (archived, record)
+                                break
+                    finally:
+                        index.close()
+        if found is None:
+            return None
+        _, (_, encoding, body) = found
+        return zlib.decompress(body), encoding
+
+    def locate_latest(self):
+        """
+        Returns the locations of the latest record of every url, as a dictionary mapping
+        writer and segment to a sorted list of offsets and times archived.
+        """
+        latest = {}
+        for key, writer, segment, offset, archived in self.entries():
+            current = latest.get(key, None)
+            if current is None or archived >= current[0]:
+                latest[key] = (archived, writer, segment, offset)
+        by_segment = {}
+        for archived, writer, segment, offset in latest.itervalues():
+            by_segment.setdefault((writer, segment), []).append((offset, archived))
+        del latest
+        for offsets in by_segment.itervalues():
+            offsets.sort()
+        return by_segment
+
+    def latest(self):
+        """
+        Iterates over the latest record of every url, as tuples of url, compressed body and
+        encoding. Reads each segment front to back. A record whose header is cut off comes
+        back as its segment and offset with an empty body, which fails to decompress.
+        """
+        with self.reading():
+            by_segment = self.locate_latest()
+            for writer, segment in sorted(by_segment):
+                with open(self.segment_path(writer, segment), 'rb') as f:
+                    for offset, archived in by_segment[(writer, segment)]:
+                        try:
+                            url, encoding, body = self.read(f, offset)
+                        except CrawlerException:
+                            yield '{0}:{1}'.format(os.path.basename(f.name), offset), '', None
+                            continue
+                        yield url, body, encoding
+
+    def compact(self):
+        """
+        Copies the latest record of every url to new segments and replaces the indexes with a
+        sorted one, then removes the superseded records. Broken records are dropped. Needs
+        the archive to itself, returns None without doing anything while it is being written
+        or read, else the number of records kept.
+        """
+        lockfile = self.flock(exclusive=True, blocking=False)
+        if lockfile is None:
+            return None
+        try:
+            old = [name for name in os.listdir(self.path) if name != 'lock']
+            writer = 'compacted-%d' % int(time() * 1000)
+            entries, segment, out = [], 0, None
+            try:
+                by_segment = self.locate_latest()
+                for source, n in sorted(by_segment):
+                    with open(self.segment_path(source, n), 'rb') as f:
+                        for offset, archived in by_segment[(source, n)]:
+                            try:
+                                url, encoding, body = self.read(f, offset)
+                                zlib.decompress(body)
+                            except (CrawlerException, zlib.error):
+                                continue  # cut short, as by a crash
+                            encoding = encoding or ''
+                            record = HEADER.pack(len(url), len(encoding), len(body)) + url + encoding + body
+                            if out is None or (out.tell() > 0 and out.tell() + len(record) > self.segment_size):
+                                if out is not None:
+                                    out.close()
+                                    segment += 1
+                                out = open(self.segment_path(writer, segment), 'wb')
+                            entries.append((url_key(url), segment, out.tell(), archived))
+                            out.write(record)
+            finally:
+                if out is not None:
+                    out.close()
+            entries.sort()
+            path = self.index_path(writer, '.sorted')
+            with open(path + '.tmp', 'wb') as f:
+                for entry in entries:
+                    f.write(ENTRY.pack(*entry))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(path + '.tmp', path)
+            # from here on the new files hold everything, a crash leaves copies at worst
+            for name in old:
+                os.remove(os.path.join(self.path, name))
+            return len(entries)
+        finally:
+            lockfile.close()
+
+
+def get_archive(domain):
+    """
+    Returns the archive of given domain in the SCREEP_ARCHIVE directory, or None if
+    archiving is off, which it is by default.
+    """
+    root = getattr(settings, 'SCREEP_ARCHIVE', None)
+    if not root:
+        return None
+    try:
+        return PageArchive(root, domain, getattr(settings, 'SCREEP_ARCHIVE_SEGMENT', 256 * 1024 * 1024))
+    except (IOError, OSError) as e:
+        raise CrawlerException(message="Cannot open the page archive of {0}: {1}".format(domain, str(e)))
@@ -0,0 +1,102 @@
+# -*-*- encoding: utf-8 -*-*-
+import sqlite3
+from django.db import connections, router
+from django.db.models import AutoField
+from django.utils.encoding import force_text
+
+
+def supports_upsert(connection):
+    """
+    Returns True if the database can insert-or-update in a single statement.
+    """
+    if connection.vendor == 'mysql':
+        return True
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 24, 0)
+    return False
+
+
+def _batches(connection, params_per_row, objs):
+    # the backend limits the number of query parameters, not the number of fields
+    size = max(1, connection.ops.bulk_batch_size([None] * params_per_row, objs))
+    for i in xrange(0, len(objs), size):
+        yield objs[i:i + size]
+
+
+def _upsert(connection, model, objs, key, update_fields):
+    """
+    Native upsert: INSERT ... ON DUPLICATE KEY UPDATE on MySQL, INSERT ... ON CONFLICT elsewhere.
+    """
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_concrete_fields if not isinstance(f, AutoField)]
+    columns = ', '.join(qn(f.column) for f in fields)
+    updates = [qn(model._meta.get_field(name).column) for name in update_fields]
+    if connection.vendor == 'mysql':
+        on_conflict = 'ON DUPLICATE KEY UPDATE ' + ', '.join('{0} = VALUES({0})'.format(c) for c in updates)
+    else:
+        on_conflict = 'ON CONFLICT ({0}) DO UPDATE SET '.format(qn(model._meta.get_field(key).column))
+        on_conflict += ', '.join('{0} = EXCLUDED.{0}'.format(c) for c in updates)
+    placeholder = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    cursor = connection.cursor()
+    for batch in _batches(connection, len(fields), objs):
+        params = []
+        for obj in batch:
+            params.extend(f.get_db_prep_save(f.pre_save(obj, True), connection=connection) for f in fields)
+        sql = 'INSERT INTO {0} ({1}) VALUES {2} {3}'.format(
+            qn(model._meta.db_table), columns, ', '.join([placeholder] * len(batch)), on_conflict)
+        cursor.execute(sql, params)
+
+
+def _bulk_update(connection, model, objs, key, update_fields):
+    """
+    Updates existing rows with one UPDATE ... SET col = CASE key WHEN ... END statement per batch.
+    """
+    qn = connection.ops.quote_name
+    key_field = model._meta.get_field(key)
+    fields = [model._meta.get_field(name) for name in update_fields]
+    cursor = connection.cursor()
+    # every row binds its key and value once per field, and its key once more in the WHERE
+    for batch in _batches(connection, 2 * len(fields) + 1, objs):
+        keys = [key_field.get_db_prep_save(getattr(obj, key_field.attname), connection=connection) for obj in batch]
+        assignments, params = [], []
+        for f in fields:
+            cases = []
+            # postgres cannot infer the type of a parameter in a CASE result
+            then = 'CAST(%s AS {0})'.format(f.db_type(connection)) if connection.vendor == 'postgresql' else '%s'
+            for k, obj in zip(keys, batch):
+                cases.append('WHEN %s THEN ' + then)
+                params.extend([k, f.get_db_prep_save(f.pre_save(obj, False), connection=connection)])
+            assignments.append('{0} = CASE {1} {2} END'.format(qn(f.column), qn(key_field.column), ' '.join(cases)))
+        params.extend(keys)
+        sql = 'UPDATE {0} SET {1} WHERE {2} IN ({3})'.format(
+            qn(model._meta.db_table), ', '.join(assignments), qn(key_field.column), ', '.join(['%s'] * len(keys)))
+        cursor.execute(sql, params)
+
+
+def bulk_upsert(model, objs, key, update_fields, existing=None):
+    """
+    Saves unsaved model instances in bulk. Rows that already exist with the same value for the
+    unique field `key` get their `update_fields` updated, other rows are inserted. Uses a native
+    upsert where the database has one, else batched CASE updates plus bulk_create, in which case
+    `existing` may hold the keys known to be in the database already to save a query.
+    Callers are expected to wrap this in a transaction.
+    """
+    if not objs:
+        return
+    update_fields = list(update_fields) + [f.name for f in model._meta.local_concrete_fields
+                                           if getattr(f, 'auto_now', False) and f.name not in update_fields]
+    connection = connections[router.db_for_write(model)]
+    if supports_upsert(connection):
+        _upsert(connection, model, objs, key, update_fields)
+        return
+    if existing is None:
+        values = [getattr(obj, key) for obj in objs]
+        existing = model._default_manager.filter(**{key + '__in': values}).values_list(key, flat=True)
+    existing = set(force_text(k) for k in existing)
+    old = [obj for obj in objs if force_text(getattr(obj, key)) in existing]
+    new = [obj for obj in objs if force_text(getattr(obj, key)) not in existing]
+    if old:
+        _bulk_update(connection, model, old, key, update_fields)
+    model._default_manager.bulk_create(new)
@@ -1,16 +1,25 @@
 # -*-*- encoding: utf-8 -*-*-
-import io
+import hashlib
+import itertools
 import logging
-import cookielib
+import re
+import socket
 import tempfile
+import urlparse
+import cookielib
 import zlib
 import requests
-import lxml.html
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import ReadTimeoutError
 from lxml import etree
-from reppy import parser
-from .models import CrawlConfig
+from time import time
+from django.core.cache import cache
+from reppy import parser, Utility, ReppyException
+from .models import CrawlConfig, PageValidators
 from .exceptions import CrawlerException
-from .utils import fast_iter, safe_str
+from .extraction import ExtractionPlan
+from .metrics import Metrics
+from .utils import charset_from_content_type, fast_iter, parse_lastmod
 
 
 log = logging.getLogger('apps')
@@ -20,7 +29,23 @@ log = logging.getLogger('apps')
 class DeclineCookiePolicy(cookielib.DefaultCookiePolicy):
     def set_ok(self, cookie, request):
         return False
-jar = cookielib.CookieJar(policy=DeclineCookiePolicy(rfc2965=True, strict_ns_domain=cookielib.DefaultCookiePolicy.DomainStrict))
+cookie_policy = DeclineCookiePolicy(rfc2965=True, strict_ns_domain=cookielib.DefaultCookiePolicy.DomainStrict)
+jar = cookielib.CookieJar(policy=cookie_policy)
+
+
+def build_session(pool_size=10):
+    """
+    Returns a requests session that keeps up to `pool_size` keep-alive connections per host.
+    The session is meant to be shared by all greenlets crawling a domain, so that consecutive
+    downloads reuse open TCP (and TLS) connections instead of doing a fresh handshake each time.
+    """
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_size, max_retries=0)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    s.max_redirects = 8  # if there's more, then the link needs an obvious fix...
+    s.cookies.set_policy(cookie_policy)
+    return s
 
 
 class GenericFactory(object):
@@ -52,70 +77,117 @@ class GzippedResponse(ResponseFactory):
     def __init__(self, **kwargs):
         super(GzippedResponse, self).__init__(**kwargs)
 
-    def get_content(self, response):
+    def iter_content(self, chunks):
         """
-        Returns decompressed content from Requests response object.
+        Decompresses an iterable of gzipped chunks, yielding the decompressed data as it becomes available.
         """
-        content = ''
-        f = tempfile.TemporaryFile()
         d = zlib.decompressobj(16 + zlib.MAX_WBITS)  # this magic number can be inferred from the structure of a gzip file
         try:
-            for block in response.iter_content(1024):
+            for block in chunks:
                 if not block:
                     break
                 data = d.decompress(block)
-                f.write(data)
-            f.seek(0)
-            content = f.read()
-        except Exception as e:
+                if data:
+                    yield data
+            data = d.flush()
+            if data:
+                yield data
+        except zlib.error as e:
             raise CrawlerException(message="Gzip decompression failed with error \"{0}\"".format(str(e)))
-        finally:
-            f.close()
-        return content
+
+    def get_content(self, response):
+        """
+        Returns decompressed content from Requests response object.
+        """
+        return ''.join(self.iter_content(response.iter_content(1024)))
+
+
+def is_timeout(e):
+    """
+    Tells whether an error reading a response was a timeout. Requests reports read timeouts
+    while streaming the body as a ConnectionError around urllib3's ReadTimeoutError.
+    """
+    if isinstance(e, (requests.Timeout, socket.timeout, ReadTimeoutError)):
+        return True
+    return bool(e.args) and isinstance(e.args[0], (socket.timeout, ReadTimeoutError))
 
 
 class DownloadFactory(GenericFactory):
     """
-    Generic downloader that uses requests.
+    Generic downloader that uses requests. Takes the configuration snapshot to use as `config`,
+    so that downloads running outside the thread that started the crawl need no database access.
+    Download times are recorded under `stage` in the crawl's `metrics`, minus any parse time.
+    The status code and download time of the last response are kept, as well as the kind of
+    error if the download failed.
     """
 
+    stage = 'fetch'
+
     def __init__(self, **kwargs):
-        self.useragent = CrawlConfig.value_for_key('USERAGENT', raise_on_dne=True)
-        self.timeout = int(CrawlConfig.value_for_key('TIMEOUT', raise_on_dne=False) or '15')
+        self.config = kwargs.get('config', None) or CrawlConfig.snapshot()
+        self.useragent = self.config.get('USERAGENT', raise_on_dne=True)
+        self.timeout = self.config.get_duration('TIMEOUT', 15)
         self.gzipped = False
-
-    def download(self, url):
+        self.session = kwargs.get('session', None)
+        self.throttle = kwargs.get('throttle', None)
+        self.metrics = kwargs.get('metrics', None) or Metrics(None)
+        self.parse_time = 0.0
+        self.elapsed = None
+        self.status_code = None
+        self.error = None
+        self.not_modified = False
+
+    def download(self, url, headers=None):
         """
         Uses requests to download data from a url. Response is processed according to type of download.
+        Extra request headers can be passed in `headers`. A '304 Not Modified' response is not processed.
         """
         if not url:
             raise CrawlerException(message="Download requires a URL.")
         url = url if '://' in url else "http://%s" % url
 
+        extra_headers = headers
         headers = {
             'Accept-Encoding': 'identity, deflate, compress, gzip',
             'Accept': '*/*',
-            'Connection': 'close',
             'User-Agent': self.useragent
         }
-        s = requests.session()
-        s.keep_alive = False
-        s.max_redirects = 8  # if there's more, then the link needs an obvious fix...
+        if extra_headers:
+            headers.update(extra_headers)
+        if self.throttle is not None:
+            self.throttle.acquire(url)
+        # use the shared connection pool if we were given one, otherwise a one-off session
+        s = self.session if self.session is not None else build_session(1)
         response = None
         responsecode = -1
+        self.parse_time = 0.0
+        start = time()
         try:
             response = s.get(url, verify=False, timeout=self.timeout, headers=headers, cookies=jar, stream=True, allow_redirects=True)
             responsecode = response.status_code
+        except requests.Timeout as e:
+            # before ConnectionError, which ConnectTimeout is one of too
+            self.error = 'timeout'
+            self.metrics.incr('errors.timeout')
+            raise CrawlerException(message="Timeout for url {0} : {1}".format(url, repr(e)))
         except requests.ConnectionError as e:
-            raise CrawlerException("Connection error for url {0} : {1}".format(url, repr(e)))
+            self.error = 'connection'
+            self.metrics.incr('errors.connection')
+            raise CrawlerException(message="Connection error for url {0} : {1}".format(url, repr(e)))
         except requests.HTTPError as e:
-            raise CrawlerException("HTTP error for url {0} : {1}".format(url, repr(e)))
+            self.error = 'http'
+            self.metrics.incr('errors.http')
+            raise CrawlerException(message="HTTP error for url {0} : {1}".format(url, repr(e)))
         except requests.TooManyRedirects as e:
-            raise CrawlerException("Too many redirects for url {0} : {1}".format(url, repr(e)))
-        except requests.Timeout as e:
-            raise CrawlerException("Timeout for url {0} : {1}".format(url, repr(e)))
+            self.error = 'redirects'
+            self.metrics.incr('errors.redirects')
+            raise CrawlerException(message="Too many redirects for url {0} : {1}".format(url, repr(e)))
         except Exception as e:
-            raise CrawlerException("Unknown error for url {0} : {1}".format(url, repr(e)))
+            self.error = 'unknown'
+            self.metrics.incr('errors.unknown')
+            raise CrawlerException(message="Unknown error for url {0} : {1}".format(url, repr(e)))
+        self.status_code = responsecode
+        self.metrics.incr('status.%d' % responsecode)
 
         content_length = response.headers.get('content-length', '0')
         try:
@@ -123,13 +195,28 @@ class DownloadFactory(GenericFactory):
         except:
             pass
 
-        elapsed = float(response.elapsed.microseconds) / 1000000
+        elapsed = response.elapsed.total_seconds()
         log.debug("[%s] (%s) %s in %ss", str(responsecode), str(content_length), url, str(elapsed))
         self.gzipped = ('gzip' in response.headers.get('content-type', ''))
-        self.process_response(response)
-        response.close()
+        self.not_modified = (responsecode == 304)
+        try:
+            if self.not_modified:
+                response.content  # empty, but reading it hands the connection back to the pool
+            else:
+                self.process_response(response)
+        except (requests.RequestException, socket.timeout) as e:
+            # the connection broke or timed out while the body was being read
+            self.error = 'timeout' if is_timeout(e) else 'connection'
+            self.metrics.incr('errors.' + self.error)
+            raise CrawlerException(message="Error reading url {0} : {1}".format(url, repr(e)))
+        finally:
+            # a fully consumed response has already returned its connection to the pool
+            response.close()
+            if s is not self.session:
+                s.close()
+        self.elapsed = time() - start - self.parse_time
+        self.metrics.timing(self.stage, self.elapsed)
         del response
-        del s
 
     def process_response(self, response):
         log.warning("No response handler implemented!")
@@ -137,25 +224,71 @@ class DownloadFactory(GenericFactory):
 
 class RobotsDownloader(DownloadFactory):
     """
-    Robots exclusion standard downloader.
+    Robots exclusion standard downloader. Parsed rules are cached per domain, for as long as
+    the response's cache headers allow or else for ROBOTSTTL seconds.
     """
 
+    stage = 'robots'
+
     def __init__(self, **kwargs):
         super(RobotsDownloader, self).__init__(**kwargs)
+        self.ttl = int(self.config.get_duration('ROBOTSTTL', 86400))
+        self.domain = None
+        self.rules = None
         self.sitemaps = []
         self.banned = False
         self.delay = None
 
+    @classmethod
+    def cache_for_domain(cls, domain):
+        return 'robots_' + domain
+
+    @classmethod
+    def is_allowed(cls, url, **kwargs):
+        """
+        Checks if the crawler may fetch given url, using the cached rules of its domain.
+        """
+        url = url if '://' in url else "http://%s" % url
+        d = cls(**kwargs)
+        d.get_for_domain(urlparse.urlsplit(url).netloc)
+        return d.allowed(url)
+
     def get_for_domain(self, domain):
-        url = "http://{0}/robots.txt".format(domain)
-        self.download(url)
+        """
+        Gets the rules for given domain from the cache, downloading robots.txt if needed.
+        """
+        self.domain = domain
+        rules = cache.get(RobotsDownloader.cache_for_domain(domain), None)
+        if rules is None:
+            self.download("http://{0}/robots.txt".format(domain))
+        else:
+            self.set_rules(rules)
 
-    def process_response(self, response):
-        rules = parser.Rules('http://otto.nl/robots.txt', response.status_code, response.content, None)
+    def set_rules(self, rules):
+        self.rules = rules
         self.sitemaps = rules.sitemaps
-        self.banned = rules.disallowed('/', self.useragent)
-        self.delay = rules.delay(self.useragent)
-        del rules
+        self.banned = not self.allowed('/')
+        agent = rules[self.useragent]
+        self.delay = agent.delay if agent is not None else None
+
+    def allowed(self, url):
+        """
+        Checks given url or path against the rules for our user agent.
+        """
+        agent = self.rules[self.useragent]
+        return agent is None or agent.allowed(url)
+
+    def process_response(self, response):
+        ttl = int(Utility.get_ttl(response.headers, self.ttl))
+        url = "http://{0}/robots.txt".format(self.domain)
+        self.metrics.incr('bytes', len(response.content))
+        try:
+            rules = parser.Rules(url, response.status_code, response.content, time() + ttl)
+        except ReppyException as e:
+            raise CrawlerException(message="Robots.txt for {0} unavailable: {1}".format(self.domain, str(e)))
+        if ttl > 0:
+            cache.set(RobotsDownloader.cache_for_domain(self.domain), rules, ttl)
+        self.set_rules(rules)
 
 
 class SitemapDownloader(DownloadFactory):
@@ -163,11 +296,15 @@ class SitemapDownloader(DownloadFactory):
     Sitemap downloader.
     """
 
+    stage = 'sitemap'
     NS = {'sm': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
+    GZIP_MAGIC = '\x1f\x8b'
+    CHUNK_SIZE = 16384
 
     def __init__(self, **kwargs):
         super(SitemapDownloader, self).__init__(**kwargs)
         self.timeout = 60  # override as some sites are slow to return sitemaps
+        self.callback = kwargs.get('callback', None)
         self.tags = []
         for t in ('sitemap', 'url'):
             self.tags.append("{%s}%s" % (SitemapDownloader.NS['sm'], t))
@@ -180,75 +317,154 @@ class SitemapDownloader(DownloadFactory):
     def process_element(self, elt):
         """
         Used with fast_iter in utils.py for fast streaming xml processing.
+        Urls are collected as (loc, lastmod) tuples, lastmod being None if absent or invalid.
+        If a callback was given, it is called with loc and lastmod instead of collecting the url.
         """
         locs = list(elt.xpath('sm:loc/text()', namespaces=SitemapDownloader.NS))
         if elt.tag.endswith('sitemap'):
             self.sitemaps += locs
         else:
-            self.urls += locs
+            lastmod = elt.xpath('sm:lastmod/text()', namespaces=SitemapDownloader.NS)
+            lastmod = parse_lastmod(lastmod[0]) if lastmod else None
+            if self.callback is not None:
+                for loc in locs:
+                    self.callback(loc, lastmod)
+            else:
+                self.urls += [(loc, lastmod) for loc in locs]
+
+    def count_bytes(self, chunks):
+        for chunk in chunks:
+            self.metrics.incr('bytes', len(chunk))
+            yield chunk
 
     def process_response(self, response):
         """
-        Parses the sitemap xml using lxml's iterparse.
+        Spools the sitemap to a temporary file, then parses the xml incrementally from there,
+        so memory use stays flat regardless of the size of the sitemap. The connection is done
+        before the first url is handed on, however long the callback blocks while the crawl
+        catches up, so servers do not cut the sitemap off for being read too slowly.
         """
-        if self.gzipped:
+        with tempfile.TemporaryFile(prefix='sitemap') as f:
+            for chunk in self.count_bytes(response.iter_content(SitemapDownloader.CHUNK_SIZE)):
+                f.write(chunk)
+            f.seek(0)
+            start = time()
+            try:
+                self.parse(f)
+            finally:
+                self.parse_time = time() - start
+
+    def parse(self, f):
+        chunks = iter(lambda: f.read(SitemapDownloader.CHUNK_SIZE), '')
+        first = next(chunks, '')
+        chunks = itertools.chain([first], chunks)
+        # gzipped sitemaps are often served as application/octet-stream, so sniff the content too
+        if self.gzipped or first.startswith(SitemapDownloader.GZIP_MAGIC):
             handler = ResponseFactory.build('gzipped')
-            content = handler.get_content(response)
-            del handler
-        else:
-            content = response.content
-        context = etree.iterparse(io.BytesIO(content), events=('end',), tag=self.tags)
-        fast_iter(context, self.process_element)
+            chunks = handler.iter_content(chunks)
+        parser = etree.XMLPullParser(events=('end',), tag=self.tags)
+        try:
+            for chunk in chunks:
+                parser.feed(chunk)
+                fast_iter(parser.read_events(), self.process_element)
+            parser.close()
+        except etree.XMLSyntaxError as e:
+            raise CrawlerException(message="Sitemap parsing failed with error \"{0}\"".format(str(e)))
+        fast_iter(parser.read_events(), self.process_element)
+        del parser
 
 
 class WebpageDownloader(DownloadFactory):
     """
-    Webpage downloader that applies xpath rules to extract desired info.
+    Webpage downloader that applies xpath rules to extract desired info. Rules are given as
+    a compiled ExtractionPlan, or as a dictionary of xpaths. With `head` set, only the html
+    head is downloaded. Pages that changed are stored in the PageArchive given as `archive`.
     """
 
+    HEAD_END = re.compile(r'</head\s*>|<body[\s>]', re.I)
+    # responses of a server asking to slow down
+    OVERLOADED = (429, 503)
+
     def __init__(self, **kwargs):
         super(WebpageDownloader, self).__init__(**kwargs)
-        self.xpaths = kwargs.get('xpaths', None)
-        if self.xpaths is None:
-            raise CrawlerException(message="You must provide an 'xpaths' keyword argument pointing to a dictionary with xpath rules!")
+        self.plan = kwargs.get('plan', None)
+        if self.plan is None:
+            xpaths = kwargs.get('xpaths', None)
+            if xpaths is None:
+                raise CrawlerException(message="You must provide a 'plan' or an 'xpaths' keyword argument pointing to a dictionary with xpath rules!")
+            self.plan = ExtractionPlan(xpaths)
         self.head_only = kwargs.get('head', False)
+        self.archive = kwargs.get('archive', None)
+        self.head_bytes = self.config.get_int('HEADBYTES', 65536)
 
-    def download(self, url):
+    def download(self, url, validators=None):
+        """
+        Downloads a webpage. If the PageValidators of a previous download are given, the request
+        is made conditional and unchanged pages are neither parsed nor returned as data.
+        """
+        self.url = url
         self.data = {}
-        super(WebpageDownloader, self).download(url)
+        self.old_validators = validators
+        self.validators = None
+        headers = {}
+        if validators is not None:
+            if validators.etag:
+                headers['If-None-Match'] = validators.etag
+            if validators.last_modified:
+                headers['If-Modified-Since'] = validators.last_modified
+        super(WebpageDownloader, self).download(url, headers=headers)
+
+    def read_head(self, response):
+        """
+        Reads the response until the end of the html head or until the byte budget runs out,
+        then closes the connection so the rest of the page is never transferred. The budget
+        applies to the decoded content, any content-encoding is handled by requests.
+        """
+        content = ''
+        for chunk in response.iter_content(chunk_size=2048):
+            if not chunk:
+                break
+            content += chunk
+            # only scan what is new, with some overlap in case the tag was split over two chunks
+            m = WebpageDownloader.HEAD_END.search(content, max(0, len(content) - len(chunk) - 6))
+            if m is not None:
+                content = content[:m.start()]
+                break
+            if len(content) >= self.head_bytes:
+                break
+        response.close()
+        return content + '</head><body></body></html>'
 
     def process_response(self, response):
         """
         Applies xpath rules.
         """
+        if response.status_code in WebpageDownloader.OVERLOADED:
+            self.error = 'overloaded'
+            self.metrics.incr('errors.overloaded')
+            raise CrawlerException(message="Server overloaded, {0} for url {1}".format(response.status_code, self.url))
         content_type = response.headers.get('content-type', '')
         if 'html' in content_type or 'xml' in content_type or 'text' in content_type:
             if self.head_only:
-                # get only the HEAD part  TODO: ensure this doesn't fuck with differently encoded content.
-                # preliminary test with http://garden-vision.net/flower/nagyo/dianthus_sp.html is OK.
-                content = ''
-                for chunk in response.iter_content(chunk_size=512):
-                    if not chunk:
-                        break
-                    content += chunk
-                    if '<body' in content or '<BODY' in content:
-                        break
-                idx = content.lower().find('<body')
-                if idx >= 0:
-                    content = content[:(idx - 1)]
-                    content += '<body></body></html>'
+                content = self.read_head(response)
             else:
                 content = response.content
-
-            tree = lxml.html.fromstring(content)
+            self.metrics.incr('bytes', len(content))
+
+            content_hash = hashlib.sha1(content).hexdigest()
+            self.validators = PageValidators(response.headers.get('etag', ''), response.headers.get('last-modified', ''), content_hash)
+            if self.old_validators is not None and self.old_validators.content_hash == content_hash:
+                # server does not support validators, but the page did not change either
+                self.not_modified = True
+                return
+
+            encoding = charset_from_content_type(content_type)
+            if self.archive is not None:
+                self.archive.append(self.url, content, encoding)
+            # without a charset in the headers, lxml looks for a meta tag in the content
+            start = time()
             try:
-                for key, xpath in self.xpaths.iteritems():
-                    m = tree.xpath(xpath)
-                    if not m:
-                        self.data[key] = ''
-                    elif isinstance(m, list):
-                        self.data[key] = safe_str(m[0])
-                    else:
-                        self.data[key] = safe_str(m)
-            except Exception as e:
-                raise CrawlerException(message="XPath extraction failed with error \"{0}\"".format(str(e)))
+                self.data = self.plan.extract(content, encoding)
+            finally:
+                self.parse_time = time() - start
+                self.metrics.timing('parse', self.parse_time)
@@ -0,0 +1,190 @@
+# -*-*- encoding: utf-8 -*-*-
+import Queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import gevent
+from gevent import monkey, pool, queue, Timeout
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .exceptions import CrawlerException
+
+
+class Engine(object):
+    """
+    Concurrency primitives used by a crawl: spawning tasks, bounded queues, worker pools
+    and timeouts. Queues are closed by putting StopIteration on them. The engine is chosen
+    per deployment with the SCREEP_ENGINE setting.
+    """
+
+    name = None
+
+    def spawn(self, func, *args):
+        """
+        Runs func(*args) concurrently. Returns a handle with join() and get(), the latter
+        returning the result or re-raising the exception of the call.
+        """
+        raise NotImplementedError
+
+    def queue(self, maxsize=None):
+        raise NotImplementedError
+
+    def pool(self, size):
+        """
+        Returns a pool of `size` workers. Its spawn() blocks while all workers are busy.
+        """
+        raise NotImplementedError
+
+    def sleep(self, seconds):
+        raise NotImplementedError
+
+    def call_blocking(self, func, *args):
+        """
+        Calls func(*args), which may block, without holding up the other tasks.
+        """
+        raise NotImplementedError
+
+    def timeout(self, seconds):
+        """
+        Context manager that silently abandons its block after given number of seconds,
+        where the engine is able to interrupt it.
+        """
+        raise NotImplementedError
+
+
+class GeventEngine(Engine):
+    """
+    Runs crawls in greenlets. Needs the standard library to be monkey patched, which happens
+    once, when the engine is created.
+    """
+
+    name = 'gevent'
+    patched = False
+
+    def __init__(self):
+        if not GeventEngine.patched:
+            monkey.patch_all(thread=False, select=False)
+            GeventEngine.patched = True
+
+    def spawn(self, func, *args):
+        return gevent.spawn(func, *args)
+
+    def queue(self, maxsize=None):
+        return queue.Queue(maxsize)
+
+    def pool(self, size):
+        return pool.Pool(size)
+
+    def sleep(self, seconds):
+        gevent.sleep(seconds)
+
+    def call_blocking(self, func, *args):
+        # wait in a thread of the hub's pool, so the other greenlets keep running
+        return gevent.get_hub().threadpool.apply(func, args)
+
+    def timeout(self, seconds):
+        return Timeout(seconds, False)
+
+
+class Thread(threading.Thread):
+    """
+    Daemon thread that keeps the outcome of its call.
+    """
+
+    def __init__(self, func, *args):
+        super(Thread, self).__init__()
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.value = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def get(self):
+        self.join()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class ThreadPool(object):
+    """
+    Starts a thread per call, but no more than `size` at the same time.
+    """
+
+    def __init__(self, size):
+        self.slots = threading.BoundedSemaphore(size)
+        self.threads = []
+
+    def _run(self, func, *args):
+        try:
+            return func(*args)
+        finally:
+            self.slots.release()
+
+    def spawn(self, func, *args):
+        self.slots.acquire()
+        self.threads = [t for t in self.threads if t.is_alive()]
+        t = Thread(self._run, func, *args)
+        self.threads.append(t)
+        t.start()
+        return t
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+
+class ThreadedEngine(Engine):
+    """
+    Runs crawls in operating system threads, without patching the standard library. Blocking
+    calls cannot be interrupted, so timeouts rely on the request timeout instead.
+    """
+
+    name = 'threaded'
+
+    def spawn(self, func, *args):
+        t = Thread(func, *args)
+        t.start()
+        return t
+
+    def queue(self, maxsize=None):
+        return Queue.Queue(maxsize or 0)
+
+    def pool(self, size):
+        return ThreadPool(size)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def call_blocking(self, func, *args):
+        return func(*args)
+
+    @contextmanager
+    def timeout(self, seconds):
+        yield
+
+
+ENGINES = dict((e.name, e) for e in (GeventEngine, ThreadedEngine))
+
+
+def get_engine(name=None):
+    """
+    Returns an instance of the named engine, or of the one in the SCREEP_ENGINE setting.
+    Names are 'gevent' (the default) and 'threaded', or the dotted path of an Engine subclass.
+    """
+    name = name or getattr(settings, 'SCREEP_ENGINE', GeventEngine.name)
+    engine = ENGINES.get(name, None)
+    if engine is None:
+        try:
+            engine = import_string(name)
+        except ImportError:
+            raise CrawlerException(message="Unknown crawl engine \"{0}\"!".format(name))
+    return engine()
@@ -10,6 +10,10 @@ class CrawlerException(Exception):
     def __str__(self):
         return "<{0}>: {1}".format(self.__class__.__name__, self.message)  # pragma: no cover
 
+    def __reduce__(self):
+        # raised in extraction worker processes too, keep the message when pickled
+        return (self.__class__, (), self.__dict__)
+
 
 class ConfigException(CrawlerException):
     """Exception thrown if a configuration is not found."""
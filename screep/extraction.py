@@ -0,0 +1,160 @@
+# -*-*- encoding: utf-8 -*-*-
+import hashlib
+import re
+import zlib
+import lxml.html
+from billiard import Pool
+from lxml import etree
+from django.core.cache import cache
+from .models import DomainAttributes
+from .exceptions import CrawlerException
+from .utils import safe_str
+
+
+class ExtractionPlan(object):
+    """
+    The xpath rules of a domain compiled into XPath objects, together with reusable
+    HTML parsers. Plans are cached per process and rebuilt whenever the domain's
+    attributes change. The `digest` of the rules tells pages extracted with other rules apart.
+    """
+
+    _plans = {}
+
+    def __init__(self, xpaths, version=None):
+        self.xpaths = xpaths
+        self.version = version
+        self.digest = fingerprint(xpaths)
+        self.parsers = {}
+        self.rules = []
+        for key, xpath in xpaths.iteritems():
+            try:
+                self.rules.append((key, etree.XPath(xpath)))
+            except etree.XPathSyntaxError as e:
+                raise CrawlerException(message="Invalid xpath \"{0}\" for \"{1}\": {2}".format(xpath, key, str(e)))
+
+    @classmethod
+    def for_domain(cls, domain):
+        """
+        Returns the cached plan for given domain, compiling it first if needed.
+        """
+        version = cache.get(DomainAttributes.cache_for_domain(domain.pk), None)
+        plan = cls._plans.get(domain.pk, None)
+        if plan is None or plan.version != version:
+            xpaths = dict(DomainAttributes.objects.filter(domain=domain).values_list('key', 'xpath'))
+            plan = cls(xpaths, version)
+            cls._plans[domain.pk] = plan
+        return plan
+
+    def get_parser(self, encoding=None):
+        """
+        Returns an HTML parser for given encoding. Comments and processing instructions
+        are dropped as no rule needs them.
+        """
+        parser = self.parsers.get(encoding, None)
+        if parser is None:
+            parser = self.parsers[encoding] = self._build_parser(encoding)
+        return parser
+
+    @staticmethod
+    def _build_parser(encoding):
+        # libxml2 does not know all python codec names ('euc_jp'), but the IANA spelling
+        # ('euc-jp', 'iso-2022-jp'). Failing both, it looks for a charset in the page itself.
+        candidates = []
+        if encoding is not None:
+            hyphenated = encoding.replace('_', '-')
+            candidates = [encoding, hyphenated, re.sub(r'^iso(?=\d)', 'iso-', hyphenated)]
+        for name in candidates + [None]:
+            try:
+                return lxml.html.HTMLParser(encoding=name, remove_comments=True, remove_pis=True)
+            except LookupError:
+                continue
+
+    def extract(self, content, encoding=None):
+        """
+        Parses the content and applies the rules. Returns a dictionary with the first match
+        of each rule, or an empty string if a rule did not match.
+        """
+        data = {}
+        try:
+            tree = lxml.html.fromstring(content, parser=self.get_parser(encoding))
+            for key, xpath in self.rules:
+                m = xpath(tree)
+                if not m:
+                    data[key] = ''
+                elif isinstance(m, list):
+                    data[key] = safe_str(m[0])
+                else:
+                    data[key] = safe_str(m)
+        except Exception as e:
+            raise CrawlerException(message="XPath extraction failed with error \"{0}\"".format(str(e)))
+        return data
+
+
+def fingerprint(data, *scope):
+    """
+    Returns a 64 bit hash of extracted values as 16 hex digits. It does not depend on the
+    order of the keys, so it is the same for the same values in every process and crawl.
+    Strings given as `scope`, such as where the values are stored, are hashed along.
+    """
+    h = hashlib.md5()
+    for s in scope:
+        h.update(safe_str(s))
+        h.update('\2')
+    for key in sorted(data):
+        h.update(safe_str(key))
+        h.update('\0')
+        h.update(safe_str(data[key]))
+        h.update('\1')
+    return h.hexdigest()[:16]
+
+
+# plan of the extraction pool worker process
+_worker_plan = None
+
+
+def _init_worker(xpaths):
+    global _worker_plan
+    _worker_plan = ExtractionPlan(xpaths)
+
+
+def _extract(content, encoding):
+    return _worker_plan.extract(content, encoding)
+
+
+def _extract_archived(record):
+    url, body, encoding = record
+    try:
+        return url, _worker_plan.extract(zlib.decompress(body), encoding), None
+    except Exception as e:  # one broken page must not end the whole run
+        return url, None, getattr(e, 'message', None) or str(e)
+
+
+class ExtractionPool(object):
+    """
+    Stands in for an ExtractionPlan, but parses pages in a pool of worker processes, so that
+    large pages do not hold up the downloads and extraction uses all cores. Every worker
+    compiles the plan once, after that only page content and extracted data cross over.
+    Waiting for a result is handed to the engine, as it blocks.
+    """
+
+    def __init__(self, plan, processes, engine):
+        self.xpaths = plan.xpaths
+        self.version = plan.version
+        self.digest = plan.digest
+        self.engine = engine
+        self.pool = Pool(processes, initializer=_init_worker, initargs=(plan.xpaths,))
+
+    def extract(self, content, encoding=None):
+        return self.engine.call_blocking(self.pool.apply, _extract, (content, encoding))
+
+    def extract_archived(self, records, chunksize=50):
+        """
+        Extracts archived pages, given as tuples of url, compressed content and encoding.
+        Iterates over tuples of url, data and an error message if extraction failed, in order.
+        Blocks the calling thread, for use outside of crawls.
+        """
+        return self.pool.imap(_extract_archived, records, chunksize)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,130 @@
+# -*-*- encoding: utf-8 -*-*-
+import hashlib
+import math
+import struct
+import threading
+
+
+class BloomFilter(object):
+    """
+    Set membership test in a fixed amount of memory, sized for `capacity` items at given
+    false positive rate. Never reports an added item as absent, but may report an item that
+    was never added as present.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        # double hashing, two 64 bit halves of one digest make all hash functions
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+    def add(self, item):
+        """
+        Adds the item. Returns False if it was (probably) present already.
+        """
+        new = False
+        array = self.array
+        for p in self.positions(item):
+            mask = 1 << (p & 7)
+            if not array[p >> 3] & mask:
+                array[p >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, item):
+        array = self.array
+        return all(array[p >> 3] & (1 << (p & 7)) for p in self.positions(item))
+
+    def __len__(self):
+        return self.count
+
+
+class SeenUrls(object):
+    """
+    Remembers the urls queued during a crawl, so urls listed in several sitemaps are fetched
+    once. Urls are kept in a set until there are more than `max_exact`, then they move to a
+    Bloom filter for `capacity` urls, which takes about 1.8 bytes per url at a 0.1% error rate.
+    A false positive means a url is skipped until the next crawl.
+    """
+
+    def __init__(self, max_exact=1000000, capacity=10000000, error_rate=0.001):
+        self.max_exact = max_exact
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.urls = set()
+        self.bloom = None
+        self.lock = threading.Lock()
+
+    def add(self, url):
+        """
+        Adds the url. Returns False if it was seen before. Safe to call from concurrent
+        sitemap downloads.
+        """
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        with self.lock:
+            return self._add(url)
+
+    def _add(self, url):
+        if self.bloom is not None:
+            return self.bloom.add(url)
+        if url in self.urls:
+            return False
+        self.urls.add(url)
+        if len(self.urls) > self.max_exact:
+            self.bloom = BloomFilter(max(self.capacity, 2 * len(self.urls)), self.error_rate)
+            for u in self.urls:
+                self.bloom.add(u)
+            self.urls = None
+        return True
+
+    def __len__(self):
+        return len(self.bloom) if self.bloom is not None else len(self.urls)
+
+
+class SitemapProgress(object):
+    """
+    Tracks which sitemaps of a crawl are complete: parsed, and every url queued from them
+    processed. Sitemap indexes and sitemaps that failed are never complete, so a resumed
+    crawl fetches them again.
+    """
+
+    def __init__(self, done=()):
+        self.done = set(done)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def started(self, sitemap):
+        with self.lock:
+            self.pending[sitemap] = [True, 0]  # parsing, number of urls in flight
+
+    def queued(self, sitemap):
+        with self.lock:
+            self.pending[sitemap][1] += 1
+
+    def parsed(self, sitemap, complete=True):
+        with self.lock:
+            self.pending[sitemap][0] = False if complete else None
+            self._check(sitemap)
+
+    def finished(self, sitemap):
+        with self.lock:
+            self.pending[sitemap][1] -= 1
+            self._check(sitemap)
+
+    def _check(self, sitemap):
+        parsing, in_flight = self.pending[sitemap]
+        if parsing or in_flight > 0:
+            return
+        del self.pending[sitemap]
+        if parsing is False:
+            self.done.add(sitemap)
@@ -0,0 +1,28 @@
+# -*-*- encoding: utf-8 -*-*-
+from time import time
+from django.core.management.base import BaseCommand, CommandError
+from ...archive import get_archive
+
+
+class Command(BaseCommand):
+    """
+    Compacts the page archives of domains: keeps only the latest copy of every page and
+    indexes them for fast lookups. Domains whose archive is in use are skipped.
+    """
+
+    args = '<domain domain ...>'
+    help = 'Removes superseded pages from the archives of domains and sorts their index.'
+
+    def handle(self, *domains, **options):
+        if not domains:
+            raise CommandError("Give one or more domains to compact the archive of.")
+        for name in domains:
+            archive = get_archive(name)
+            if archive is None:
+                raise CommandError("Archiving is off, set SCREEP_ARCHIVE to the archive directory.")
+            start = time()
+            kept = archive.compact()
+            if kept is None:
+                self.stderr.write("{0}: archive in use, skipped".format(name))
+            else:
+                self.stdout.write("{0}: kept {1} pages in {2:.1f}s".format(name, kept, time() - start))
@@ -0,0 +1,65 @@
+# -*-*- encoding: utf-8 -*-*-
+import multiprocessing
+from optparse import make_option
+from time import time
+from django.core.management.base import BaseCommand, CommandError
+from ...archive import get_archive
+from ...engines import get_engine
+from ...extraction import ExtractionPlan, ExtractionPool
+from ...models import CrawlDomain
+from ...registry import registry
+from ...tasks import CrawlerTask
+
+
+class Command(BaseCommand):
+    """
+    Applies the current domain attributes to the archived pages of domains and stores the
+    results, without downloading anything. Pages are parsed in parallel by worker processes.
+    """
+
+    args = '<domain domain ...>'
+    help = 'Extracts the attributes of domains again from their archived pages.'
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=None,
+                    help='Number of worker processes, the number of cpus by default.'),
+    )
+
+    def handle(self, *domains, **options):
+        if not domains:
+            raise CommandError("Give one or more domains to extract again.")
+        processes = options.get('processes', None) or multiprocessing.cpu_count()
+        for name in domains:
+            try:
+                domain = CrawlDomain.objects.get(domain=name)
+            except CrawlDomain.DoesNotExist:
+                raise CommandError("Unknown domain \"{0}\".".format(name))
+            archive = get_archive(domain.domain)
+            if archive is None:
+                raise CommandError("Archiving is off, set SCREEP_ARCHIVE to the archive directory.")
+            self.reextract(domain, archive, processes)
+
+    def reextract(self, domain, archive, processes):
+        start = time()
+        crawler = CrawlerTask(domain, registry.get_model(registry.label_for(domain.domain)), force=True,
+                              engine=get_engine('threaded'))
+        pool = ExtractionPool(ExtractionPlan.for_domain(domain), processes, crawler.engine)
+        crawler.plan = pool
+        pages = failed = 0
+        try:
+            for url, data, error in pool.extract_archived(archive.latest()):
+                if data is None:
+                    failed += 1
+                    self.stderr.write("{0}: {1}".format(url, error))
+                    continue
+                crawler.batch[url] = data
+                pages += 1
+                if len(crawler.batch) >= crawler.batchsize:
+                    crawler.consolidate()
+            if crawler.batch:
+                crawler.consolidate()
+        finally:
+            pool.close()
+            archive.close()
+        rows = crawler.metrics.counters.get('db.rows', 0)
+        self.stdout.write("{0}: extracted {1} pages, {2} rows written, {3} failed in {4:.1f}s".format(
+            domain.domain, pages, rows, failed, time() - start))
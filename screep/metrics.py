@@ -0,0 +1,207 @@
+# -*-*- encoding: utf-8 -*-*-
+import logging
+import socket
+import threading
+from contextlib import contextmanager
+from time import time
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .exceptions import CrawlerException
+
+
+log = logging.getLogger('apps')
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed buckets, in milliseconds.
+    """
+
+    BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(Histogram.BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        for i, bound in enumerate(Histogram.BUCKETS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the bucket holding the p-th percentile, or the maximum
+        if that is lower.
+        """
+        seen, rank = 0, p / 100.0 * self.count
+        for bound, n in zip(Histogram.BUCKETS, self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics(object):
+    """
+    Instrumentation of the crawl of one domain: latency histograms per stage and counters
+    for bytes, response status codes and errors. Every measurement is passed on to the
+    sink as well, which gets the totals on flush().
+    """
+
+    def __init__(self, domain, sink=None):
+        self.domain = domain
+        self.sink = sink or NullSink()
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def timing(self, stage, seconds):
+        ms = seconds * 1000.0
+        with self.lock:
+            h = self.histograms.get(stage, None)
+            if h is None:
+                h = self.histograms[stage] = Histogram()
+            h.add(ms)
+        self.sink.timing(self.domain, stage, ms)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time()
+        try:
+            yield
+        finally:
+            self.timing(stage, time() - start)
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+        self.sink.incr(self.domain, name, count)
+
+    def flush(self):
+        self.sink.flush(self)
+
+
+class NullSink(object):
+    """
+    Sink that drops everything. Also the base class for sinks.
+    """
+
+    def timing(self, domain, stage, ms):
+        pass
+
+    def incr(self, domain, name, count):
+        pass
+
+    def flush(self, metrics):
+        pass
+
+
+class LoggingSink(NullSink):
+    """
+    Logs a summary of each crawl when it is done.
+    """
+
+    def flush(self, metrics):
+        for stage, h in sorted(metrics.histograms.iteritems()):
+            log.info("%s %s: n=%d mean=%.1fms p50=%.1fms p95=%.1fms max=%.1fms total=%.1fs",
+                     metrics.domain, stage, h.count, h.mean, h.percentile(50), h.percentile(95), h.max, h.total / 1000)
+        if metrics.counters:
+            log.info("%s %s", metrics.domain, ' '.join('%s=%d' % c for c in sorted(metrics.counters.iteritems())))
+
+
+class MemorySink(NullSink):
+    """
+    Keeps all measurements in memory, for tests.
+    """
+
+    def __init__(self):
+        self.timings = []
+        self.counts = []
+        self.flushed = []
+
+    def timing(self, domain, stage, ms):
+        self.timings.append((domain, stage, ms))
+
+    def incr(self, domain, name, count):
+        self.counts.append((domain, name, count))
+
+    def flush(self, metrics):
+        self.flushed.append(metrics)
+
+
+class StatsdSink(NullSink):
+    """
+    Sends measurements to a statsd compatible daemon over UDP, as '<prefix>.<domain>.<name>'.
+    Lines are buffered into packets that fit a network frame.
+    """
+
+    MAX_PACKET = 1400
+
+    def __init__(self, host='localhost', port=8125, prefix='screep'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.buffer = []
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def name(self, domain, name):
+        return '.'.join([self.prefix, domain.replace('.', '_').replace(':', '_'), name])
+
+    def send(self, line):
+        with self.lock:
+            if self.buffer and self.size + len(line) + 1 > StatsdSink.MAX_PACKET:
+                self._send()
+            self.buffer.append(line)
+            self.size += len(line) + 1
+
+    def _send(self):
+        try:
+            self.socket.sendto('\n'.join(self.buffer), self.address)
+        except socket.error as e:
+            log.warning("Could not send metrics: %s" % str(e))
+        self.buffer = []
+        self.size = 0
+
+    def timing(self, domain, stage, ms):
+        self.send('%s:%.3f|ms' % (self.name(domain, stage), ms))
+
+    def incr(self, domain, name, count):
+        self.send('%s:%d|c' % (self.name(domain, name), count))
+
+    def flush(self, metrics):
+        with self.lock:
+            if self.buffer:
+                self._send()
+
+
+SINKS = {'null': NullSink, 'logging': LoggingSink, 'memory': MemorySink, 'statsd': StatsdSink}
+
+
+def get_sink(name=None):
+    """
+    Returns a new instance of the named sink, or of the one in the SCREEP_METRICS setting.
+    Names are 'logging' (the default), 'statsd', 'memory' and 'null', or the dotted path of
+    a sink class. The configured sink gets the keyword arguments in SCREEP_METRICS_OPTIONS.
+    """
+    options = {}
+    if name is None:
+        name = getattr(settings, 'SCREEP_METRICS', 'logging')
+        options = getattr(settings, 'SCREEP_METRICS_OPTIONS', {})
+    sink = SINKS.get(name, None)
+    if sink is None:
+        try:
+            sink = import_string(name)
+        except ImportError:
+            raise CrawlerException(message="Unknown metrics sink \"{0}\"!".format(name))
+    return sink(**options)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screep', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrawlPage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('url', models.CharField(unique=True, max_length=255)),
+                ('etag', models.CharField(default=b'', max_length=255, blank=True)),
+                ('last_modified', models.CharField(default=b'', max_length=64, blank=True)),
+                ('content_hash', models.CharField(default=b'', help_text=b'SHA1 of the response body.', max_length=40, blank=True)),
+                ('domain', models.ForeignKey(related_name=b'pages', to='screep.CrawlDomain')),
+            ],
+            options={
+                'verbose_name': 'crawled page',
+                'verbose_name_plural': 'crawled pages',
+            },
+            bases=(models.Model,),
+        ),
+    ]
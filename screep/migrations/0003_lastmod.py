@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screep', '0002_crawlpage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawldomain',
+            name='fullcrawl',
+            field=models.BooleanField(default=False, help_text=b'Crawl all sitemap urls, ignoring their lastmod.'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='crawlpage',
+            name='lastscraped',
+            field=models.DateTimeField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
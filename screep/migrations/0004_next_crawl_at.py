@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+from django.db import models, migrations
+
+
+def set_next_crawl_at(apps, schema_editor):
+    CrawlDomain = apps.get_model('screep', 'CrawlDomain')
+    for domain in CrawlDomain.objects.all().iterator():
+        CrawlDomain.objects.filter(pk=domain.pk).update(next_crawl_at=domain.lastcrawl + timedelta(hours=domain.ttl))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screep', '0003_lastmod'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawldomain',
+            name='next_crawl_at',
+            field=models.DateTimeField(default=datetime(1970, 1, 1, 0, 0), help_text=b'Lastcrawl plus ttl, kept up to date on save.', editable=False),
+            preserve_default=True,
+        ),
+        migrations.RunPython(set_next_crawl_at, lambda apps, schema_editor: None),
+        migrations.AlterIndexTogether(
+            name='crawldomain',
+            index_together=set([('next_crawl_at', 'status')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screep', '0004_next_crawl_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrawlCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('started', models.DateTimeField()),
+                ('sitemaps', models.TextField(default=b'', help_text=b'Completed sitemaps, one per line.', blank=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('domain', models.OneToOneField(related_name='checkpoint', to='screep.CrawlDomain')),
+            ],
+            options={
+                'verbose_name': 'crawl checkpoint',
+                'verbose_name_plural': 'crawl checkpoints',
+            },
+            bases=(models.Model,),
+        ),
+    ]
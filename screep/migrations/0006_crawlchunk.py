@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screep', '0005_crawlcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrawlChunk',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('urls', models.TextField(help_text=b'Urls to crawl, one per line.')),
+                ('status', models.IntegerField(default=0, choices=[(0, b'pending'), (1, b'claimed'), (2, b'done')])),
+                ('claimed', models.DateTimeField(null=True, blank=True)),
+                ('domain', models.ForeignKey(related_name='chunks', to='screep.CrawlDomain')),
+            ],
+            options={
+                'verbose_name': 'crawl chunk',
+                'verbose_name_plural': 'crawl chunks',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='crawlchunk',
+            index_together=set([('domain', 'status')]),
+        ),
+        migrations.AddField(
+            model_name='crawldomain',
+            name='shards',
+            field=models.IntegerField(default=1, help_text=b'Number of workers sharing the crawl of the domain.'),
+            preserve_default=True,
+        ),
+    ]
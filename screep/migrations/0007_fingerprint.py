@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screep', '0006_crawlchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawlpage',
+            name='fingerprint',
+            field=models.CharField(default=b'', help_text=b'Hash of the values last stored for the url.', max_length=16, blank=True),
+            preserve_default=True,
+        ),
+    ]
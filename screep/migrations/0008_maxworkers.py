@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screep', '0007_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawldomain',
+            name='maxworkers',
+            field=models.IntegerField(help_text=b'Maximum number of concurrent downloads, instead of MAXWORKERS.', null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
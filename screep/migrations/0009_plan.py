@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screep', '0008_maxworkers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawlpage',
+            name='plan',
+            field=models.CharField(default=b'', help_text=b'Digest of the xpath rules the url was last extracted with.', max_length=16, blank=True),
+            preserve_default=True,
+        ),
+    ]
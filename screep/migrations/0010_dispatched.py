@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screep', '0009_plan'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawldomain',
+            name='dispatched',
+            field=models.DateTimeField(help_text=b'When the running crawl of the domain was dispatched.', null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -4,23 +4,82 @@ __version__ = '$Revision: 1.0 $'[11:-2]
 __date__ = '$Date: 2014/06/06 13:37:00 $'
 __copyright__ = 'Copyright (C) 2013 Adriaan Tijsseling.'
 
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
+from time import time
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.cache import cache
+from django.utils import timezone
 from model_utils.models import TimeStampedModel
 from model_utils import Choices
 from .helpers import DomainNameField
 from .exceptions import ConfigException
 
 
+class ConfigSnapshot(object):
+    """
+    In-process copy of all crawl configuration items, loaded with a single query. Lookups
+    cost nothing; CrawlConfig.snapshot() reloads it when the config version in the cache changes.
+    """
+
+    DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+    def __init__(self, values, version):
+        self.values = values
+        self.version = version
+        self.checked = time()
+
+    def get(self, key, default=None, raise_on_dne=False):
+        """
+        Returns the value for given key, or default if not found unless
+        caller prefers an exception to be raised.
+        """
+        val = self.values.get(key, None)
+        if val is None:
+            if raise_on_dne:
+                raise ConfigException(key=key)
+            return default
+        return val
+
+    def get_int(self, key, default=None):
+        try:
+            return int(self.values[key])
+        except (KeyError, ValueError):
+            return default
+
+    def get_float(self, key, default=None):
+        try:
+            return float(self.values[key])
+        except (KeyError, ValueError):
+            return default
+
+    def get_duration(self, key, default=None):
+        """
+        Returns a duration in seconds. Values are plain seconds or have a unit suffix,
+        as in '90s', '15m', '2h' or '1d'.
+        """
+        val = self.values.get(key, '').strip().lower()
+        multiplier = ConfigSnapshot.DURATION_UNITS.get(val[-1:], None)
+        if multiplier is not None:
+            val = val[:-1]
+        try:
+            return float(val) * (multiplier or 1)
+        except ValueError:
+            return default
+
+
 class CrawlConfig(models.Model):
     """
     Editable configuration for the crawler. Works on key-value basis.
     """
 
+    VERSION_KEY = 'config_version'
+    CHECK_INTERVAL = 30  # seconds between checks of the config version
+    _snapshot = None
+
     key = models.CharField(max_length=50, null=False, blank=False, db_index=True, unique=True)
     value = models.CharField(max_length=200, default='')
 
@@ -54,18 +113,41 @@ class CrawlConfig(models.Model):
             cache.set(cache_key, val, 300)
         return val
 
+    @classmethod
+    def snapshot(cls):
+        """
+        Returns the in-process ConfigSnapshot. Every CHECK_INTERVAL seconds the config version
+        in the cache is compared, and all items are reloaded if it changed.
+        """
+        snapshot = cls._snapshot
+        now = time()
+        if snapshot is not None and now - snapshot.checked < cls.CHECK_INTERVAL:
+            return snapshot
+        version = cache.get(cls.VERSION_KEY, None)
+        if version is None:
+            cache.add(cls.VERSION_KEY, now, None)
+            version = cache.get(cls.VERSION_KEY, now)
+        elif snapshot is not None and snapshot.version == version:
+            snapshot.checked = now
+            return snapshot
+        cls._snapshot = ConfigSnapshot(dict(cls.objects.values_list('key', 'value')), version)
+        return cls._snapshot
+
     def __unicode__(self):
         return self.key  # pragma: no cover
 
 
-@receiver(post_save, sender=CrawlConfig)
+@receiver([post_save, post_delete], sender=CrawlConfig)
 def set_domain(sender, **kwargs):
     """
-    Everytime a config item changes, we must invalidate the cached value.
+    Everytime a config item changes, we must invalidate the cached value and bump
+    the version, so all processes reload their snapshot.
     """
     instance = kwargs.get('instance')
     cache_key = CrawlConfig.cache_for_key(instance.key)
     cache.delete(cache_key)
+    cache.set(CrawlConfig.VERSION_KEY, time(), None)
+    CrawlConfig._snapshot = None
 
 
 class CrawlDomain(TimeStampedModel):
@@ -82,22 +164,72 @@ class CrawlDomain(TimeStampedModel):
     status = models.IntegerField(db_index=True, choices=STATUS_TYPES, default=STATUS_TYPES.ok)
     ttl = models.IntegerField(default=24, help_text="Interval between crawls in hours.")
     lastcrawl = models.DateTimeField(default=datetime(1970, 1, 1))
+    next_crawl_at = models.DateTimeField(default=datetime(1970, 1, 1), editable=False, help_text="Lastcrawl plus ttl, kept up to date on save.")
+    fullcrawl = models.BooleanField(default=False, help_text="Crawl all sitemap urls, ignoring their lastmod.")
+    shards = models.IntegerField(default=1, help_text="Number of workers sharing the crawl of the domain.")
+    maxworkers = models.IntegerField(null=True, blank=True, help_text="Maximum number of concurrent downloads, instead of MAXWORKERS.")
+    dispatched = models.DateTimeField(null=True, blank=True, editable=False, help_text="When the running crawl of the domain was dispatched.")
 
     class Meta:
         verbose_name = "crawl domain"
         verbose_name_plural = "crawl domains"
-        index_together = [["ttl", "lastcrawl"]]
+        index_together = [["next_crawl_at", "status"]]
 
     def __unicode__(self):
         return self.domain  # pragma: no cover
 
+    def save(self, *args, **kwargs):
+        self.next_crawl_at = self.lastcrawl + timedelta(hours=self.ttl)
+        update_fields = kwargs.get('update_fields', None)
+        if update_fields is not None and ('lastcrawl' in update_fields or 'ttl' in update_fields):
+            kwargs['update_fields'] = list(update_fields) + ['next_crawl_at']
+        super(CrawlDomain, self).save(*args, **kwargs)
+
+    def claim(self, now=None):
+        """
+        Marks the domain as crawled now, unless someone else did so since it was loaded.
+        Returns True if the domain was claimed.
+        """
+        now = now or timezone.now()
+        next_crawl_at = now + timedelta(hours=self.ttl)
+        claimed = CrawlDomain.objects.filter(pk=self.pk, lastcrawl=self.lastcrawl).update(lastcrawl=now, next_crawl_at=next_crawl_at)
+        if claimed:
+            self.lastcrawl, self.next_crawl_at = now, next_crawl_at
+        return claimed > 0
+
     @classmethod
-    def get_stale_domains(cls):
+    def stale_domains(cls, now=None):
         """
-        Returns all domains that needs to be re-crawled. Django has no way to query based on the value
-        of a table column, so we'll do it raw.
+        Returns a queryset of domains that need to be re-crawled, most overdue first.
         """
-        return list(cls.objects.raw('SELECT * FROM screep_crawldomain WHERE status < 2 AND lastcrawl < (NOW() - INTERVAL ttl HOUR)'))
+        now = now or timezone.now()
+        return cls.objects.filter(next_crawl_at__lt=now, status__lt=cls.STATUS_TYPES.disabled).order_by('next_crawl_at', 'pk')
+
+    @classmethod
+    def get_stale_domains(cls, limit=None):
+        """
+        Returns a list of domains that need to be re-crawled.
+        """
+        qs = cls.stale_domains()
+        return list(qs[:limit] if limit is not None else qs)
+
+    @classmethod
+    def iter_stale_domains(cls, chunk_size=1000):
+        """
+        Iterates over the domains that need to be re-crawled, fetching them in chunks. Domains
+        claimed in the meantime drop out, as their next_crawl_at moves into the future.
+        """
+        now = timezone.now()
+        qs = cls.stale_domains(now)
+        while True:
+            chunk = list(qs[:chunk_size])
+            for domain in chunk:
+                yield domain
+            if len(chunk) < chunk_size:
+                return
+            last = chunk[-1]
+            qs = cls.stale_domains(now).filter(
+                models.Q(next_crawl_at__gt=last.next_crawl_at) | models.Q(next_crawl_at=last.next_crawl_at, pk__gt=last.pk))
 
 
 class DomainAttributes(models.Model):
@@ -113,3 +245,192 @@ class DomainAttributes(models.Model):
     class Meta:
         verbose_name = "domain attribute"
         verbose_name_plural = "domain attributes"
+
+    @classmethod
+    def cache_for_domain(cls, domain_id):
+        return 'plan_' + str(domain_id)
+
+
+@receiver([post_save, post_delete], sender=DomainAttributes)
+def invalidate_plan(sender, **kwargs):
+    """
+    Everytime an attribute changes, the compiled extraction plans of its domain must be rebuilt.
+    """
+    instance = kwargs.get('instance')
+    cache.set(DomainAttributes.cache_for_domain(instance.domain_id), time(), None)
+
+
+PageValidators = namedtuple('PageValidators', ['etag', 'last_modified', 'content_hash'])
+
+
+class CrawlPage(models.Model):
+    """
+    Crawl state of a single url. Stores the validators of the last response so
+    later crawls can do a conditional GET and skip pages that have not changed, and
+    a fingerprint of the extracted values, to skip writing values that did not change.
+    """
+
+    domain = models.ForeignKey(CrawlDomain, blank=False, null=False, related_name='pages')
+    url = models.CharField(max_length=255, null=False, blank=False, unique=True)
+    etag = models.CharField(max_length=255, blank=True, default='')
+    last_modified = models.CharField(max_length=64, blank=True, default='')
+    content_hash = models.CharField(max_length=40, blank=True, default='', help_text="SHA1 of the response body.")
+    fingerprint = models.CharField(max_length=16, blank=True, default='', help_text="Hash of the values last stored for the url.")
+    plan = models.CharField(max_length=16, blank=True, default='', help_text="Digest of the xpath rules the url was last extracted with.")
+    lastscraped = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "crawled page"
+        verbose_name_plural = "crawled pages"
+
+    def __unicode__(self):
+        return self.url  # pragma: no cover
+
+    @classmethod
+    def state_for(cls, urls, chunk_size=500):
+        """
+        Returns a dictionary mapping url to a tuple of PageValidators, the time the url was
+        last scraped and the digest of the rules it was extracted with, for the given urls that
+        were crawled before. Queries in chunks, to stay below the query parameter limits of
+        the database.
+        """
+        state = {}
+        for i in xrange(0, len(urls), chunk_size):
+            rows = cls.objects.filter(url__in=urls[i:i + chunk_size]).values_list(
+                'url', 'etag', 'last_modified', 'content_hash', 'lastscraped', 'plan')
+            for row in rows:
+                state[row[0]] = (PageValidators(*row[1:4]), row[4], row[5])
+        return state
+
+    @classmethod
+    def scraped_since(cls, domain, since):
+        """
+        Iterates over the urls of given domain that were scraped at or after `since`.
+        """
+        return cls.objects.filter(domain=domain, lastscraped__gte=since).values_list('url', flat=True).iterator()
+
+    @classmethod
+    def fingerprints_for(cls, urls):
+        """
+        Returns a dictionary mapping url to the fingerprint stored for it, for the given urls.
+        """
+        return dict(cls.objects.filter(url__in=urls).exclude(fingerprint='').values_list('url', 'fingerprint'))
+
+
+class CrawlCheckpoint(models.Model):
+    """
+    Progress of an unfinished crawl of a domain, so that an interrupted crawl can resume.
+    Pages scraped since `started` are done. Sitemaps listed in `sitemaps` were parsed and
+    all their urls processed, so they need not be downloaded again.
+    """
+
+    domain = models.OneToOneField(CrawlDomain, related_name='checkpoint')
+    started = models.DateTimeField()
+    sitemaps = models.TextField(blank=True, default='', help_text="Completed sitemaps, one per line.")
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "crawl checkpoint"
+        verbose_name_plural = "crawl checkpoints"
+
+    def __unicode__(self):
+        return self.domain.domain  # pragma: no cover
+
+    @property
+    def done_sitemaps(self):
+        return [s for s in self.sitemaps.split('\n') if s]
+
+    @classmethod
+    def resume_or_start(cls, domain, max_age, now=None):
+        """
+        Returns the checkpoint of given domain and whether it resumes an interrupted crawl.
+        Checkpoints that were not updated for `max_age` seconds start over.
+        """
+        now = now or timezone.now()
+        checkpoint = cls.objects.filter(domain=domain).first()
+        if checkpoint is not None and checkpoint.updated >= now - timedelta(seconds=max_age):
+            return checkpoint, True
+        if checkpoint is None:
+            checkpoint = cls(domain=domain)
+        checkpoint.started = now
+        checkpoint.sitemaps = ''
+        checkpoint.save()
+        return checkpoint, False
+
+    def store(self, sitemaps):
+        self.sitemaps = '\n'.join(sorted(sitemaps))
+        self.save(update_fields=['sitemaps', 'updated'])
+
+
+class CrawlChunk(models.Model):
+    """
+    Part of the urls of a domain crawled by several workers at once. The crawl that parses
+    the sitemaps writes the chunks, workers claim one at a time and mark it done once all
+    its pages are consolidated. Chunks of a worker that died are claimed again after a while.
+    """
+
+    STATUS_TYPES = Choices((0, 'pending', 'pending'), (1, 'claimed', 'claimed'), (2, 'done', 'done'))
+
+    domain = models.ForeignKey(CrawlDomain, related_name='chunks')
+    urls = models.TextField(help_text="Urls to crawl, one per line.")
+    status = models.IntegerField(choices=STATUS_TYPES, default=STATUS_TYPES.pending)
+    claimed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "crawl chunk"
+        verbose_name_plural = "crawl chunks"
+        index_together = [["domain", "status"]]
+
+    def __unicode__(self):
+        return u'%s #%d' % (self.domain.domain, self.pk)  # pragma: no cover
+
+    @property
+    def url_list(self):
+        return [u for u in self.urls.split('\n') if u]
+
+    @classmethod
+    def cache_for_domain(cls, domain_id):
+        # set while the sitemaps of the domain are being split into chunks
+        return 'chunks_' + str(domain_id)
+
+    @classmethod
+    def claim_next(cls, domain, timeout, now=None):
+        """
+        Claims the oldest pending chunk of given domain, or a chunk claimed more than `timeout`
+        seconds ago. Returns None if there is none. Safe to call from concurrent workers.
+        """
+        now = now or timezone.now()
+        available = cls.objects.filter(domain=domain).filter(
+            models.Q(status=cls.STATUS_TYPES.pending) |
+            models.Q(status=cls.STATUS_TYPES.claimed, claimed__lt=now - timedelta(seconds=timeout)))
+        while True:
+            chunk = available.order_by('pk').first()
+            if chunk is None:
+                return None
+            # someone else may claim it in the meantime, then try the next one
+            if cls.objects.filter(pk=chunk.pk, status=chunk.status, claimed=chunk.claimed).update(
+                    status=cls.STATUS_TYPES.claimed, claimed=now):
+                chunk.status, chunk.claimed = cls.STATUS_TYPES.claimed, now
+                return chunk
+
+    @classmethod
+    def in_progress(cls, domain):
+        """
+        Returns a queryset of the chunks of given domain that are claimed but not done.
+        """
+        return cls.objects.filter(domain=domain, status=cls.STATUS_TYPES.claimed)
+
+    @classmethod
+    def stale(cls, domain, timeout, now=None):
+        """
+        Returns a queryset of the chunks of given domain that nobody works on any more:
+        done, pending or claimed more than `timeout` seconds ago.
+        """
+        now = now or timezone.now()
+        return cls.objects.filter(domain=domain).exclude(
+            status=cls.STATUS_TYPES.claimed, claimed__gte=now - timedelta(seconds=timeout))
+
+    def finish(self):
+        # the chunk may have been deleted in the meantime, if its claim expired
+        self.status = CrawlChunk.STATUS_TYPES.done
+        CrawlChunk.objects.filter(pk=self.pk).update(status=self.status)
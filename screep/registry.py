@@ -0,0 +1,85 @@
+# -*-*- encoding: utf-8 -*-*-
+from django.apps import apps
+from django.conf import settings
+from .models import DomainAttributes
+from .exceptions import CrawlerException
+
+
+class TargetRegistry(object):
+    """
+    Maps domains to the models that store their scraped content, as 'app_label.Model'
+    references. Models are declared with the SCREEP_TARGET_MODEL setting, or per domain
+    with SCREEP_TARGET_MODELS, or by calling register(). References are resolved to
+    model classes once per process.
+    """
+
+    def __init__(self):
+        self.default = None
+        self.domains = {}
+        self.models = {}
+        self.detected = None
+
+    @staticmethod
+    def label(model):
+        if isinstance(model, basestring):
+            return model
+        return "{0}.{1}".format(model._meta.app_label, model._meta.object_name)
+
+    def register(self, model, domain=None):
+        """
+        Registers a model class or reference as target model for given domain name,
+        or as the default target model if no domain is given.
+        """
+        if domain is None:
+            self.default = self.label(model)
+        else:
+            self.domains[domain] = self.label(model)
+
+    def label_for(self, domain):
+        """
+        Returns the reference of the target model for given domain name.
+        """
+        return (self.domains.get(domain, None) or
+                getattr(settings, 'SCREEP_TARGET_MODELS', {}).get(domain, None) or
+                self.default or
+                getattr(settings, 'SCREEP_TARGET_MODEL', None) or
+                self.autodetect())
+
+    def get_model(self, label):
+        """
+        Resolves a model reference to the model class.
+        """
+        model = self.models.get(label, None)
+        if model is None:
+            try:
+                model = apps.get_model(label)
+            except (LookupError, ValueError):
+                raise CrawlerException(message="Unknown target model \"{0}\"!".format(label))
+            if 'url' not in [f.name for f in model._meta.fields]:
+                raise CrawlerException(message="Target model must have a 'url' field!")
+            self.models[label] = model
+        return model
+
+    def model_for(self, domain):
+        return self.get_model(self.label_for(domain))
+
+    def autodetect(self):
+        """
+        Fallback for when no target model is declared: finds a model that has fields for all
+        domain attributes. This is done once per process.
+        """
+        if self.detected is not None:
+            return self.detected
+        atts = set(DomainAttributes.objects.all().values_list('key', flat=True).distinct())
+        for app_config in apps.get_app_configs():
+            if app_config.name.startswith('django') or app_config.name in ('south', 'screep'):  # exclude usual suspects
+                continue
+            for m in app_config.get_models():
+                fields = set(f.name for f in m._meta.fields)
+                if atts <= fields and 'url' in fields:
+                    self.detected = self.label(m)  # Got it!
+                    return self.detected
+        raise CrawlerException(message="No model found to store scraped content!")
+
+
+registry = TargetRegistry()
@@ -1,126 +1,202 @@
 # -*-*- encoding: utf-8 -*-*-
 from __future__ import absolute_import
+import re
+import signal
 import sys
+import threading
 import traceback
+from billiard.pool import SIG_SOFT_TIMEOUT
 from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
 import logging
-from time import time, sleep
-import gevent
-from gevent import monkey, queue, event, pool, Timeout
-from django.db.models import get_app, get_models
-from django.conf import settings
-from .models import CrawlDomain, DomainAttributes
+from datetime import timedelta
+from time import time
+from django.core.cache import cache
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.encoding import force_text
+from .models import CrawlCheckpoint, CrawlChunk, CrawlConfig, CrawlDomain, CrawlPage, DomainAttributes
 from .exceptions import ConfigException, CrawlerException
-from .downloader import RobotsDownloader, SitemapDownloader, WebpageDownloader
+from .archive import get_archive
+from .db import bulk_upsert
+from .downloader import RobotsDownloader, SitemapDownloader, WebpageDownloader, build_session
+from .engines import get_engine
+from .extraction import ExtractionPlan, ExtractionPool, fingerprint
+from .frontier import SeenUrls, SitemapProgress
+from .metrics import Metrics, get_sink
+from .registry import registry
+from .throttle import AdaptiveLimit, HostThrottle
 
-monkey.patch_all(thread=False, select=False)
 log = logging.getLogger('apps')
 
+# xpath steps that select elements which only occur in the html head
+HEAD_XPATH = re.compile(r'(^|/)(head|meta|title)\b')
+
 
 @shared_task(ignore_result=True)
 def crawl():
+    """Dispatches crawls of stale domains, as many as there are free slots."""
+    cc = CrawlerControl()
+    cc.start()
+
+
+@shared_task(ignore_result=True)
+def crawl_done(domain_id=None):
+    """Callback of a finished crawl_task. Frees its slot and refills it right away."""
     cc = CrawlerControl()
+    if domain_id is not None:
+        cc.slots.release(domain_id)
     cc.start()
 
 
-@shared_task(soft_time_limit=86400, hard_time_limit=86400)
-def crawl_task(domain, target_model):
-    """This is a subtask invoked by the main import worker."""
+# the hard limit leaves time to save progress after the soft limit
+@shared_task(soft_time_limit=86400, time_limit=86400 + 600)
+def crawl_task(domain_id, target_model, force=False):
+    """
+    This is a subtask invoked by the main import worker. Takes the primary key of a CrawlDomain
+    and an 'app_label.Model' reference to the target model. Use `force` to ignore sitemap lastmod dates.
+    """
+    try:
+        domain = CrawlDomain.objects.get(pk=domain_id)
+        crawler_class = ShardedCrawl if domain.shards > 1 else CrawlerTask
+        crawler = crawler_class(domain, registry.get_model(target_model), force=force)
+        crawler.start()
+    except Exception as e:
+        log_failure(e)
+
+
+@shared_task(soft_time_limit=86400, time_limit=86400 + 600)
+def crawl_shard_task(domain_id, target_model, force=False):
+    """
+    Crawls chunks of the urls of a domain that is crawled by several workers at once,
+    see ShardedCrawl. Takes the same arguments as crawl_task.
+    """
     try:
-        crawler = CrawlerTask(domain, target_model)
+        domain = CrawlDomain.objects.get(pk=domain_id)
+        crawler = ShardTask(domain, registry.get_model(target_model), force=force)
         crawler.start()
     except Exception as e:
-        t, v, tb = sys.exc_info()
-        extra = ''
-        if t is not None:
-            extra = t.__name__ + ": " + repr(v) + "\n" + "\n".join(traceback.format_tb(tb))
-        log.error("Subtask failed with exception: %s\n%s" % (repr(e), extra))
+        log_failure(e)
+
+
+def log_failure(e):
+    t, v, tb = sys.exc_info()
+    extra = ''
+    if t is not None:
+        extra = t.__name__ + ": " + repr(v) + "\n" + "\n".join(traceback.format_tb(tb))
+    log.error("Subtask failed with exception: %s\n%s" % (repr(e), extra))
 
 
 class Job(object):
     """
-    Url download job to be used with concurrent processing.
+    Url download job to be used with concurrent processing. Jobs only hold what differs
+    per url, the extraction plan is shared by the crawl.
     """
 
-    def __init__(self, url, xpaths, head=False):
+    __slots__ = ('url', 'sitemap', 'queued', 'data', 'validators')
+
+    def __init__(self, url, sitemap=None, validators=None):
         self.url = url
-        self.xpaths = xpaths
-        self.head = head
+        self.sitemap = sitemap
+        self.queued = time()
+        # validators of the previous download, to make a conditional request
+        self.validators = validators
 
-    def __hash__(self):
-        return hash(self.url)
+    def __repr__(self):
+        return '<Job: %s (%s)>' % (self.url, 'done' if hasattr(self, 'data') else 'pending')
 
-    def __cmp__(self, other):
-        return cmp(hash(self), hash(other))
 
-    def __repr__(self):
-        return '<Job: %s (%s)>' % (
-            self.url,
-            'done: %d' % len(self.data) if hasattr(self, 'data') else 'pending',
-        )
+class Lookup(object):
+    """
+    Batch of jobs for urls listed in the sitemaps, with their lastmod, whose crawl state is
+    looked up in the calling thread on behalf of the producer. The jobs to download are put
+    on `reply`.
+    """
+
+    __slots__ = ('batch', 'reply')
+
+    def __init__(self, batch, reply):
+        self.batch = batch
+        self.reply = reply
+
+
+class CrawlSlots(object):
+    """
+    Counts the domains being crawled by all workers, as the domains marked as dispatched in
+    the database. Marks expire a while after the longest possible crawl, so slots lost by
+    killed workers come back.
+    """
+
+    timeout = 86400 + 3600
+
+    def expired(self, now=None):
+        return (now or timezone.now()) - timedelta(seconds=CrawlSlots.timeout)
+
+    def acquire(self, domain, limit):
+        """
+        Takes a slot for given domain if less than `limit` are taken and the domain holds none.
+        Returns True on success. Safe to call from concurrent dispatchers, which may both back
+        off when they race for the last slot, but never take more than `limit` together.
+        """
+        now = timezone.now()
+        free = models.Q(dispatched__isnull=True) | models.Q(dispatched__lt=self.expired(now))
+        if not CrawlDomain.objects.filter(free, pk=domain.pk).update(dispatched=now):
+            return False
+        if self.taken(now) > limit:
+            self.release(domain.pk)
+            return False
+        return True
+
+    def release(self, domain_id):
+        CrawlDomain.objects.filter(pk=domain_id).update(dispatched=None)
+
+    def taken(self, now=None):
+        return CrawlDomain.objects.filter(dispatched__gte=self.expired(now)).count()
 
 
 class CrawlerControl(object):
     """
     Controls the crawling of domains.
-    Selects domains that need to be crawled and peforms the following in succession:
+    Selects domains that need to be crawled and dispatches a crawl_task for each, as long as
+    there are free slots. A finished crawl_task frees its slot and calls back to dispatch the
+    next domain, so the controller never waits for crawls to finish. Each crawl_task
+    performs the following in succession:
     - retrieve robots.txt and verify
     - retrieve and parse sitemap
     - concurrently download and extract sitemap links.
     """
     def __init__(self):
         self.domains = None
-        self.target_model = None
-        self.subtasks = []
-
-    def _get_target_model(self):
-        """
-        Makes sure we have xpath rules for scraping and  a model to store scraped content.
-        """
-        # grab all possible attributes used with xpath
-        atts = set(DomainAttributes.objects.all().values_list('key', flat=True).distinct())
-        if len(atts) == 0:
-            raise CrawlerException(message="You have not yet defined attributes to scrape!")
-        target_app, target_model = None, None
-        for app_label in settings.INSTALLED_APPS:
-            if not 'django' in app_label and app_label not in ('south', 'screep'):  # exclude usual suspects
-                try:
-                    app = get_app(app_label)
-                    for m in get_models(app):
-                        f_list = set()
-                        for f in m._meta.fields:
-                            f_list.add(f.name)
-                        if set(atts) <= set(f_list):
-                            # check for 'url' attribute
-                            if 'url' not in f_list:
-                                raise CrawlerException(message="Target model must have a 'url' field!")
-                            self.target_model = m  # Got it!
-                            return
-                except:
-                    continue  # might be an app without a models.py file
+        self.slots = CrawlSlots()
 
     def start(self):
         """
         Entrance to crawl controller process.
         """
-        self._get_target_model()
-        if not self.target_model:
-            raise CrawlerException(message="No model found to store scraped content!")
+        if not DomainAttributes.objects.exists():
+            raise CrawlerException(message="You have not yet defined attributes to scrape!")
+        limit = CrawlConfig.snapshot().get_int('MAXDOMAINS', 5)
         # grab stale domains
-        self.domains = CrawlDomain.get_stale_domains()
+        self.domains = CrawlDomain.iter_stale_domains(chunk_size=limit)
         for domain in self.domains:
-            pid = crawl_task.delay(domain, self.target_model)
-            self.subtasks.append(pid)
-
-            # sleep until we have idling subtasks
-            while len(self.subtasks) > 4:
-                sleep(10)
-                log.warning("Polling %d subtasks" % len(self.subtasks))
-                for pid in list(self.subtasks):
-                    results = crawl_task.AsyncResult(pid)
-                    if results.ready():
-                        log.warning("subtask %s done" % str(pid))
-                        self.subtasks.remove(pid)
+            # resolve the target model here, so misconfigurations surface before dispatching
+            try:
+                target_model = registry.label_for(domain.domain)
+                registry.get_model(target_model)
+            except CrawlerException as e:
+                # not claimed, it was not crawled, and is retried once the configuration is fixed
+                log.error("{0}: not dispatched, {1}".format(domain.domain, e.message))
+                continue
+            if domain.dispatched is not None and domain.dispatched >= self.slots.expired():
+                continue  # still being crawled, its interval is shorter than the crawl
+            if not self.slots.acquire(domain, limit):
+                break
+            # claim the domain, so concurrent dispatchers do not crawl it too
+            if not domain.claim():
+                self.slots.release(domain.pk)
+                continue
+            crawl_task.apply_async((domain.pk, target_model), link=crawl_done.si(domain.pk), link_error=crawl_done.si(domain.pk))
+            log.info("Dispatched %s, %d domains in flight" % (domain.domain, self.slots.taken()))
 
 
 class CrawlerTask(object):
@@ -132,15 +208,41 @@ class CrawlerTask(object):
     - concurrently download and extract sitemap links.
     """
 
-    def __init__(self, domain, target_model):
+    def __init__(self, domain, target_model, force=False, engine=None):
         self.crawldomain = domain
         self.target_model = target_model
+        self.target_label = registry.label(target_model)
+        # only crawl urls that changed since they were last scraped, unless a full crawl is wanted
+        self.incremental = not (force or domain.fullcrawl)
         self.sitemaps = None
         self.delay = None
-        self.urlqueue = queue.Queue()
+        self.config = CrawlConfig.snapshot()
+        # concurrency primitives, greenlets by default, see engines.py
+        self.engine = engine or get_engine()
+        self.urlqueue = self.engine.queue(self.config.get_int('QUEUESIZE', 1000))
         self.batchsize = 100
-        self.dataqueue = queue.Queue(self.batchsize)
+        self.dataqueue = self.engine.queue(self.batchsize)
         self.batch = {}
+        self.pages = {}
+        self.fingerprints = {}
+        self.unchanged = []
+        self.batch_sitemaps = []
+        self.plan = None
+        self.head_only = False
+        self.extraction_pool = None
+        # raw pages are archived if SCREEP_ARCHIVE is set, so they can be extracted again later
+        self.archive = get_archive(domain.domain)
+        self.session = None
+        self.robots = None
+        self.throttle = None
+        self.limit = None
+        # urls queued so far, kept exactly up to DEDUPEXACT urls, then in a Bloom filter
+        self.seen = SeenUrls(self.config.get_int('DEDUPEXACT', 1000000), self.config.get_int('DEDUPCAPACITY', 10000000))
+        self.checkpoint = None
+        self.progress = SitemapProgress()
+        self.checkpointed = time()
+        self.stopped = False
+        self.metrics = Metrics(domain.domain, get_sink())
 
     def start(self):
         """
@@ -149,164 +251,445 @@ class CrawlerTask(object):
         start = time()
         self.sitemaps = None
         self.delay = None
+        # keep-alive connection pool shared by all downloads of this crawl
+        self.session = build_session(self.config.get_int('POOLSIZE', 10))
+        previous_handler = self.handle_time_limit()
         try:
             self.get_robots_es()
-            self.collect_urls()
             self.download_urls()
+        except SoftTimeLimitExceeded:
+            log.warning("{0}: time limit reached, saving progress".format(self.crawldomain.domain))
+            self.stop()
         except ConfigException as e:
             log.error("No configuration found for key \"{0}\"!".format(e.key))
         except CrawlerException as e:
             log.error("Crawler exception: {0}".format(e.message))
         except Exception as e:
             log.error("Unknown exception: {0}".format(str(e)))
+        finally:
+            if previous_handler is not None:
+                signal.signal(SIG_SOFT_TIMEOUT, previous_handler)
+            self.session.close()
+            if self.extraction_pool is not None:
+                self.extraction_pool.close()
+                self.extraction_pool = None
+            if self.archive is not None:
+                self.archive.close()
+        if self.limit is not None:
+            self.metrics.incr('concurrency.decreases', self.limit.decreases)
+            log.info("{0}: {1} concurrent downloads at the end, reduced {2} times".format(
+                self.crawldomain.domain, self.limit.size, self.limit.decreases))
+        self.metrics.timing('crawl', time() - start)
+        self.metrics.flush()
         log.info("{0}: {1}".format(self.crawldomain.domain, str(time() - start)))
 
+    def handle_time_limit(self):
+        """
+        Celery signals the soft time limit, and the default handler raises SoftTimeLimitExceeded
+        in whatever greenlet or thread happens to run, rarely the one that can save the progress.
+        Instead the crawl is told to stop, and the pipeline stores what was scraped and
+        checkpoints the progress once the downloads in flight are done. Returns the previous
+        handler, or None if signals cannot be handled here.
+        """
+        if SIG_SOFT_TIMEOUT is None:
+            return None
+
+        def time_limit(signum, frame):
+            if not self.stopped:
+                log.warning("{0}: time limit reached, saving progress".format(self.crawldomain.domain))
+            self.stopped = True
+        try:
+            return signal.signal(SIG_SOFT_TIMEOUT, time_limit)
+        except ValueError:  # not in the main thread
+            return None
+
     def get_robots_es(self):
         """
         Download robots exclusion standard, verifies access and retrieves sitemaps.
         """
-        d = RobotsDownloader()
+        d = RobotsDownloader(session=self.session, config=self.config, metrics=self.metrics)
         d.get_for_domain(self.crawldomain.domain)
         if d.banned:
             raise CrawlerException(message="Access to {0} is banned for {1}!".format(self.crawldomain.domain, d.useragent))
         self.delay = d.delay
         self.sitemaps = d.sitemaps
-        del d
+        self.robots = d
+        # requests per second to the domain, unless robots.txt asks for a crawl delay
+        rate = self.config.get_float('REQUESTRATE', 10)
+        self.throttle = HostThrottle(self.crawldomain.domain, rate, self.delay, self.engine.sleep)
 
     def _can_use_head(self, xpaths):
         """
         Checks if the xpaths apply only to the HEAD section of a webpage. Useful to speed up processing.
         """
         for value in xpaths.itervalues():
-            if not 'head' in value and not 'meta' in value:
-                return False
+            for path in value.split('|'):
+                if HEAD_XPATH.search(path) is None:
+                    return False
         return True
 
+    def producer(self):
+        """
+        Feeds the url queue from the sitemaps. The queue is bounded, so the producer
+        blocks whenever the downloaders fall behind.
+        """
+        try:
+            self.collect_urls()
+        finally:
+            self.urlqueue.put(StopIteration)
+
     def collect_urls(self):
         """
         Downloads and parses all available sitemaps and collects the urls.
         """
-        # grab xpaths to use
-        xpaths = dict(DomainAttributes.objects.filter(domain=self.crawldomain).values_list('key', 'xpath'))
-        head_only = self._can_use_head(xpaths)
-        # loop through sitemaps
-        downloader = SitemapDownloader()
-        sm_list = list(self.sitemaps)
-        # just for testing
-        while len(sm_list) > 0:
-            sitemap = sm_list.pop(0)
-            downloader.download(sitemap)
-            for s in downloader.sitemaps:
-                if s not in self.sitemaps:
-                    # some sitemap.xml files have duplicate entries!
-                    sm_list.append(s)
-            for url in downloader.urls:
-                job = Job(url, xpaths, head_only)
-                self.urlqueue.put(job)
+        seen = self.seen
+        # urls are looked up in batches, the sitemaps are parsed concurrently
+        pending = []
+        lock = threading.Lock()
+        batchsize = max(1, self.config.get_int('LOOKUPBATCH', 500))
+
+        def enqueue(url, lastmod, sitemap):
+            if self.stopped:
+                return
+            if not seen.add(url):
+                self.metrics.incr('urls.duplicate')
+                return  # listed in another sitemap too
+            if not self.robots.allowed(url):
+                return
+            self.progress.queued(sitemap)
+            with lock:
+                pending.append((Job(url, sitemap), lastmod))
+                if len(pending) < batchsize:
+                    return
+                batch = pending[:]
+                del pending[:]
+            self.queue_jobs(batch)
+
+        # sitemaps are fetched concurrently, one level of sitemap indexes at a time,
+        # and urls are queued while the sitemaps are being parsed
+        max_depth = self.config.get_int('SITEMAPDEPTH', 3)
+        max_count = self.config.get_int('SITEMAPMAX', 1000)
+        sitemap_pool = self.engine.pool(max(1, self.config.get_int('SITEMAPWORKERS', 4)))
+        visited = set()
+        level = list(self.sitemaps)
+        depth = 0
+        while level:
+            fetches = []
+            for sitemap in level:
+                if sitemap in visited:
+                    continue  # listed twice, or an index refers back to itself
+                if sitemap in self.progress.done:
+                    self.metrics.incr('sitemaps.resumed')
+                    continue  # completed before the crawl was interrupted
+                if len(visited) >= max_count:
+                    log.warning("{0}: more than {1} sitemaps, skipping the rest".format(self.crawldomain.domain, max_count))
+                    break
+                visited.add(sitemap)
+                fetches.append(sitemap_pool.spawn(self.fetch_sitemap, sitemap, enqueue))
+            sitemap_pool.join()
+            level = [s for f in fetches for s in f.get()]
+            depth += 1
+            if level and depth > max_depth:
+                log.warning("{0}: sitemap indexes nested deeper than {1} levels, skipping {2} sitemaps".format(
+                    self.crawldomain.domain, max_depth, len(level)))
+                break
+        if pending and not self.stopped:
+            self.queue_jobs(pending)
+
+    def queue_jobs(self, batch):
+        """
+        Queues the jobs of a batch of urls from the sitemaps once their crawl state is looked up.
+        """
+        for job in self.lookup(batch):
+            self.urlqueue.put(job)
+
+    def lookup(self, batch):
+        """
+        Has the pipeline look up the crawl state of a batch of jobs and lastmods, so database
+        access stays in the calling thread. Returns the jobs to download.
+        """
+        request = Lookup(batch, self.engine.queue(1))
+        self.dataqueue.put(request)
+        return request.reply.get()
+
+    def answer(self, lookup):
+        """
+        Looks up the crawl state of the urls of a Lookup. Urls not modified since they were
+        last scraped are skipped, the others get the validators of their previous download.
+        Pages extracted with other rules, or all pages of a full crawl, are downloaded again.
+        """
+        jobs = []
+        state = CrawlPage.state_for([job.url for job, lastmod in lookup.batch])
+        for job, lastmod in lookup.batch:
+            validators, lastscraped, plan = state.get(job.url, (None, None, None))
+            if not self.incremental or plan != self.plan.digest:
+                validators = lastscraped = None
+            if lastmod is not None and lastscraped is not None and lastmod <= lastscraped:
+                self.progress.finished(job.sitemap)  # not modified since we last scraped it
+                continue
+            job.validators = validators
+            jobs.append(job)
+        lookup.reply.put(jobs)
+
+    def fetch_sitemap(self, url, callback):
+        """
+        Downloads and parses one sitemap, passing its urls to the callback. Returns the sitemaps
+        it refers to if it is a sitemap index. Failures are logged, so other sitemaps still get crawled.
+        """
+        if self.stopped:
+            return []
+        d = SitemapDownloader(session=self.session, throttle=self.throttle, config=self.config,
+                              metrics=self.metrics, callback=lambda loc, lastmod: callback(loc, lastmod, url))
+        self.progress.started(url)
+        try:
+            d.download(url)
+        except CrawlerException as e:
+            self.progress.parsed(url, complete=False)
+            self.metrics.incr('errors.sitemap')
+            log.error("Crawler exception: {0}".format(e.message))
+            return []
+        self.progress.parsed(url, complete=not d.sitemaps and not self.stopped)
+        return d.sitemaps
 
     def download_urls(self):
         """
-        Starts the scheduler & the pipeline.
+        Starts the producer & the scheduler and runs the pipeline. Downloads start as soon
+        as the first urls are parsed from the sitemaps. All database access happens here,
+        in the calling thread, so the other stages only do network i/o and parsing.
+        """
+        self.load_plan()
+        self.resume()
+        self.producer_task = self.engine.spawn(self.producer)
+        self.scheduler_task = self.engine.spawn(self.scheduler)
+        self.pipeline()
+        self.scheduler_task.get()
+        self.producer_task.get()  # re-raises any sitemap errors
+        if not self.stopped:
+            self.checkpoint.delete()  # done, the next crawl starts from scratch
+
+    def load_plan(self):
+        """
+        Loads the compiled xpath rules to apply to the pages of the domain.
         """
-        self.scheduler_greenlet = gevent.spawn(self.scheduler)
-        self.pipeline_greenlet = gevent.spawn(self.pipeline)
-        self.scheduler_greenlet.join()
+        self.plan = ExtractionPlan.for_domain(self.crawldomain)
+        # archived pages must be complete, for rules that may be added later
+        self.head_only = self.archive is None and self._can_use_head(self.plan.xpaths)
+        # parse pages in worker processes, so parsing does not hold up the downloads
+        processes = self.config.get_int('EXTRACTWORKERS', 0)
+        if processes > 0:
+            self.extraction_pool = ExtractionPool(self.plan, processes, self.engine)
+            self.plan = self.extraction_pool
+
+    def resume(self):
+        """
+        Picks up where an interrupted crawl of the domain left off, if it did so recently:
+        pages scraped since it started and its completed sitemaps are skipped.
+        """
+        max_age = self.config.get_duration('CHECKPOINTTTL', 86400)
+        self.checkpoint, resumed = CrawlCheckpoint.resume_or_start(self.crawldomain, max_age)
+        self.checkpointed = time()
+        if not resumed:
+            return
+        self.progress = SitemapProgress(self.checkpoint.done_sitemaps)
+        done = 0
+        for url in CrawlPage.scraped_since(self.crawldomain, self.checkpoint.started):
+            self.seen.add(url)
+            done += 1
+        log.info("{0}: resuming crawl, {1} pages and {2} sitemaps done".format(
+            self.crawldomain.domain, done, len(self.progress.done)))
 
     def scheduler(self):
         """
-        Url download scheduler. Processes items from the job queue until empty.
+        Url download scheduler. Processes items from the job queue until the producer is done.
         """
-        # make a properly sized pool
-        worker_count = 1 if self.delay is not None else 4
-        self.pool = pool.Pool(worker_count)
-        self.worker_finished = event.Event()
-
-        while True:
-            for greenlet in list(self.pool):
-                if greenlet.dead:
-                    self.pool.discard(greenlet)
-            try:
-                job = self.urlqueue.get_nowait()
-            except queue.Empty:
-                log.debug("No jobs remaining.")
-                if self.pool.free_count() != self.pool.size:
-                    log.debug("%d workers remaining, waiting..." % (self.pool.size - self.pool.free_count()))
-                    self.worker_finished.wait()
-                    self.worker_finished.clear()
-                    continue
-                else:
-                    log.debug("No workers left, shutting down.")
-                    return self.shutdown()
-            self.pool.spawn(self.worker, job)
+        # make a pool no larger than the rate limit can keep busy, so that a worker
+        # never waits longer for its turn than it would for a page to download
+        max_workers = self.crawldomain.maxworkers or self.config.get_int('MAXWORKERS', 10)
+        timeout = self.config.get_duration('TIMEOUT', 15)
+        rate = self.throttle.rate_for_domain
+        worker_count = max_workers if rate <= 0 else max(1, min(max_workers, int(rate * timeout)))
+        self.pool = self.engine.pool(worker_count)
+        # how many of the workers are used depends on how well the site copes, see AdaptiveLimit
+        if self.limit is None:
+            min_workers = min(self.config.get_int('MINWORKERS', 2), worker_count)
+            self.limit = AdaptiveLimit(min_workers, worker_count, self.config.get_float('LATENCYFACTOR', 2.0))
+
+        for job in iter(self.urlqueue.get, StopIteration):
+            self.limit.acquire(self.engine.sleep)
+            self.pool.spawn(self.worker, job)  # blocks until a worker is free
+        log.debug("No jobs remaining, shutting down.")
+        return self.shutdown()
 
     def worker(self, job):
         """
-        Fetches urls fed through gevent queue. Processed jobs are pushed
-        on the dataqueue for processing in the pipeline thread.
+        Fetches urls fed through the url queue. Processed jobs are pushed
+        on the dataqueue for processing in the pipeline.
         """
         log.debug("starting: %r" % job)
-        d = WebpageDownloader(xpaths=job.xpaths, head=False)
+        self.metrics.timing('queue_wait', time() - job.queued)
+        d = WebpageDownloader(plan=self.plan, head=self.head_only, session=self.session, throttle=self.throttle,
+                              config=self.config, metrics=self.metrics, archive=self.archive)
         success = False
 
-        with Timeout(120, False):  # we set a hard limit on the timeout
-            try:
-                d.download(job.url)
-                success = True
-            except CrawlerException as e:
-                log.error("Crawler exception: {0}".format(e.message))
-            except Exception as e:
-                log.error("Unknown exception: {0}".format(e.message))
+        if self.stopped:
+            self.limit.release()
+            return
+        abandoned = True
+        try:
+            with self.engine.timeout(120):  # we set a hard limit on the timeout
+                try:
+                    d.download(job.url, job.validators)
+                    success = True
+                except CrawlerException as e:
+                    log.error("Crawler exception: {0}".format(e.message))
+                except SoftTimeLimitExceeded:
+                    self.stopped = True  # raised here by a handler other than ours
+                except Exception as e:
+                    log.error("Unknown exception: {0}".format(e.message))
+                abandoned = False
+        finally:
+            if abandoned and d.error is None:
+                # the engine gave up on the download without a word
+                d.error = 'timeout'
+                self.metrics.incr('errors.timeout')
+                log.error("Timeout for url {0}".format(job.url))
+            overloaded = d.error == 'timeout' or d.status_code in WebpageDownloader.OVERLOADED
+            self.limit.release(d.elapsed if success else None, overloaded)
 
         if success:
-            job.data = d.data
-            self.dataqueue.put(job)
+            # unchanged pages go through the pipeline without data, only to mark them as scraped
+            job.data = None if d.not_modified else d.data
+            job.validators = d.validators
+            self.metrics.incr('pages.unchanged' if d.not_modified else 'pages.scraped')
+            if not self.stopped:
+                self.dataqueue.put(job)
+        else:
+            self.metrics.incr('pages.failed')
+            if job.sitemap is not None:
+                self.progress.finished(job.sitemap)
 
         del d
-        self.worker_finished.set()
         log.debug("finished: %r" % job)
-        raise gevent.GreenletExit('success')
 
     def pipeline(self):
         """
         Processes scraped content.
         """
-        for job in self.dataqueue:
-            self.batch[job.url] = job.data
-            if len(self.batch) >= self.batchsize:
-                self.consolidate()
-        # ensure we consolidate remaining items
+        for job in iter(self.dataqueue.get, StopIteration):
+            if isinstance(job, Lookup):
+                self.answer(job)
+                continue
+            if job.data is None:
+                self.unchanged.append(job.url)
+            else:
+                self.batch[job.url] = job.data
+                if job.validators is not None:
+                    self.pages[job.url] = job.validators
+            if job.sitemap is not None:
+                self.batch_sitemaps.append(job.sitemap)
+            if len(self.batch) + len(self.unchanged) >= self.batchsize:
+                self.flush()
+        # ensure we consolidate remaining items, and save the progress of a stopped crawl
         log.warning("Consolidating final batch")
-        if len(self.batch) > 0:
+        self.flush(checkpoint=self.stopped)
+
+    def flush(self, checkpoint=False):
+        """
+        Consolidates the current batch and marks its urls as processed. Saves a checkpoint
+        every CHECKPOINTINTERVAL seconds, or right away with `checkpoint` set.
+        """
+        if len(self.batch) + len(self.unchanged) > 0:
             self.consolidate()
+        for sitemap in self.batch_sitemaps:
+            self.progress.finished(sitemap)
+        del self.batch_sitemaps[:]
+        interval = self.config.get_duration('CHECKPOINTINTERVAL', 60)
+        if self.checkpoint is not None and (checkpoint or time() - self.checkpointed >= interval):
+            self.checkpoint.store(self.progress.done)
+            self.checkpointed = time()
+
+    def stop(self):
+        """
+        Stops an unfinished crawl: stores what was scraped so far and checkpoints the progress,
+        so the next crawl of the domain can resume. Downloads still in flight are dropped.
+        """
+        self.stopped = True
+        while not self.dataqueue.empty():
+            job = self.dataqueue.get_nowait()  # unblocks workers waiting to hand over their page
+            if isinstance(job, Lookup):
+                job.reply.put([])  # and the producer waiting for its lookup
+        self.flush(checkpoint=True)
 
     def consolidate(self):
         """
-        Consolidates scraped data to database. Existing items are updated,
-        new items are inserted in bulk.
-        """
-        existing = list(self.target_model.objects.filter(url__in=self.batch.keys()))
-        old_urls = []
-        # first update existing database entries
-        for obj in existing:
-            old_urls.append(obj.url)
-            d = self.batch.get(obj.url, None)
-            if d is None:
-                log.error("Problems with url casing: {0}".format(obj.url))
-            else:
-                for key, val in d.iteritems():
-                    setattr(obj, key, val)
-                obj.save(update_fields=d.keys())
-        # batch insert new entries
-        new_urls = list(set(self.batch.keys()) - set(old_urls))
-        to_create = []
-        for key in new_urls:
-            d = self.batch[key]
-            atts = {'url': key}
-            atts.update(d)
-            to_create.append(self.target_model(**atts))
-        self.target_model.objects.bulk_create(to_create)
+        Consolidates scraped data to database in one transaction per batch. Rows whose
+        values did not change are skipped, the others are upserted in bulk. Values are
+        only read back for rows whose fingerprint changed. Fingerprints cover the target model
+        and the rules too, so rows are written again when either changes.
+        """
+        fields = set()
+        for d in self.batch.itervalues():
+            fields.update(d.iterkeys())
+        fields = sorted(fields)
+        with self.metrics.timer('consolidate'), transaction.atomic():
+            # rows whose fingerprint matches the stored one are left alone without reading them,
+            # as long as they are still there
+            stored = CrawlPage.fingerprints_for(self.batch.keys())
+            candidates, same = [], []
+            for url, d in self.batch.iteritems():
+                self.fingerprints[url] = fingerprint(d, self.target_label, self.plan.digest)
+                if stored.get(force_text(url), None) != self.fingerprints[url]:
+                    candidates.append(url)
+                else:
+                    same.append(url)
+            if same:
+                found = set(force_text(url) for url in self.target_model.objects.filter(url__in=same).values_list('url', flat=True))
+                candidates.extend(url for url in same if force_text(url) not in found)
+            existing = {}
+            for row in self.target_model.objects.filter(url__in=candidates).values_list('url', *fields).iterator():
+                existing[force_text(row[0])] = [force_text(v) for v in row[1:]]
+            changed = []
+            for url in candidates:
+                d = self.batch[url]
+                old = existing.get(force_text(url), None)
+                if old is not None and old == [force_text(d.get(f, '')) for f in fields]:
+                    continue
+                atts = {'url': url}
+                atts.update(d)
+                changed.append(self.target_model(**atts))
+            bulk_upsert(self.target_model, changed, 'url', fields, existing=existing.iterkeys())
+            self.metrics.incr('db.rows', len(changed))
+            self.metrics.incr('db.unchanged', len(self.batch) - len(changed))
+            self.consolidate_pages()
         self.batch.clear()
-        del to_create, new_urls, old_urls, existing
+        del changed, existing, candidates, same
+
+    def consolidate_pages(self):
+        """
+        Stores the response validators and scrape time of the consolidated pages, so the next
+        crawl can skip urls that did not change and make conditional requests for the others.
+        """
+        now = timezone.now()
+        if self.unchanged:
+            CrawlPage.objects.filter(url__in=self.unchanged).update(lastscraped=now)
+            self.metrics.incr('db.rows', len(self.unchanged))
+            del self.unchanged[:]
+        pages = []
+        for url, v in self.pages.iteritems():
+            if len(url) <= 255:
+                pages.append(CrawlPage(domain=self.crawldomain, url=url, etag=v.etag, last_modified=v.last_modified, content_hash=v.content_hash,
+                                       fingerprint=self.fingerprints.get(url, ''), plan=self.plan.digest, lastscraped=now))
+        bulk_upsert(CrawlPage, pages, 'url', ['etag', 'last_modified', 'content_hash', 'fingerprint', 'plan', 'lastscraped'])
+        self.metrics.incr('db.rows', len(pages))
+        # pages extracted without downloading them, such as from the archive, only get their fingerprint
+        extracted = [CrawlPage(domain=self.crawldomain, url=url, fingerprint=fp, plan=self.plan.digest)
+                     for url, fp in self.fingerprints.iteritems() if url not in self.pages and len(url) <= 255]
+        if extracted:
+            bulk_upsert(CrawlPage, extracted, 'url', ['fingerprint', 'plan'])
+            self.metrics.incr('db.rows', len(extracted))
+        self.pages.clear()
+        self.fingerprints.clear()
+        del pages
 
     def shutdown(self):
         """
@@ -314,5 +697,133 @@ class CrawlerTask(object):
         """
         self.pool.join()
         self.dataqueue.put(StopIteration)
-        self.pipeline_greenlet.join()
         return True
+
+
+class ShardedCrawl(CrawlerTask):
+    """
+    Crawls a domain too large for one worker with several, as many as its `shards`.
+    Parses the sitemaps like any crawl, but instead of downloading the urls it writes them
+    to the database in chunks of SHARDCHUNK urls. Once the first chunk is written, one
+    crawl_shard_task per shard is dispatched to download and consolidate the chunks.
+    """
+
+    def download_urls(self):
+        # the urls are looked up against the rules, but extracted by the shards
+        self.plan = ExtractionPlan.for_domain(self.crawldomain)
+        # chunks left over from the previous crawl are stale, their urls are listed again,
+        # but shards of that crawl may still be working on theirs
+        CrawlChunk.stale(self.crawldomain, self.config.get_duration('SHARDTIMEOUT', 3600)).delete()
+        key = CrawlChunk.cache_for_domain(self.crawldomain.pk)
+        cache.set(key, True, 86400)
+        try:
+            self.write_chunks()
+        finally:
+            cache.delete(key)
+
+    def write_chunks(self):
+        """
+        Collects the urls from the producer and stores them in chunks. Runs in the calling
+        thread, like the pipeline of a regular crawl, so database access stays in one place.
+        """
+        size = max(1, self.config.get_int('SHARDCHUNK', 1000))
+        producer = self.engine.spawn(self.producer)
+        urls, chunks = [], 0
+        for job in iter(self.urlqueue.get, StopIteration):
+            if isinstance(job, Lookup):
+                self.answer(job)
+                continue
+            urls.append(job.url)
+            if len(urls) >= size:
+                chunks += self.write_chunk(urls, chunks)
+                urls = []
+        if urls:
+            chunks += self.write_chunk(urls, chunks)
+        producer.get()
+        log.info("{0}: {1} chunks for {2} shards".format(self.crawldomain.domain, chunks, self.crawldomain.shards))
+
+    def write_chunk(self, urls, written):
+        CrawlChunk.objects.create(domain=self.crawldomain, urls='\n'.join(urls))
+        self.metrics.incr('chunks')
+        if written == 0:
+            for i in xrange(self.crawldomain.shards):
+                crawl_shard_task.apply_async((self.crawldomain.pk, self.target_label, not self.incremental))
+        return 1
+
+    def lookup(self, batch):
+        # the urls are looked up while the chunks are written
+        request = Lookup(batch, self.engine.queue(1))
+        self.urlqueue.put(request)
+        return request.reply.get()
+
+
+class ShardTask(CrawlerTask):
+    """
+    One of the workers of a ShardedCrawl. Claims chunks of urls one by one and crawls them
+    like a regular crawl, until the sitemaps are done and no chunk is left to claim. Every
+    shard makes its share of the requests the domain allows, so together they stay within it.
+    """
+
+    def __init__(self, domain, target_model, force=False, engine=None):
+        super(ShardTask, self).__init__(domain, target_model, force=force, engine=engine)
+        self.chunk = None
+        self.validators = {}
+
+    def get_robots_es(self):
+        super(ShardTask, self).get_robots_es()
+        shards = max(1, self.crawldomain.shards)
+        self.throttle = HostThrottle(self.crawldomain.domain, self.throttle.rate / shards,
+                                     self.delay * shards if self.delay else None, self.engine.sleep)
+
+    def download_urls(self):
+        self.load_plan()
+        timeout = self.config.get_duration('SHARDTIMEOUT', 3600)
+        key = CrawlChunk.cache_for_domain(self.crawldomain.pk)
+        while not self.stopped:
+            # look at the flag before claiming, so a last chunk written in between is not missed
+            producing = cache.get(key, False)
+            self.chunk = CrawlChunk.claim_next(self.crawldomain, timeout)
+            if self.chunk is not None:
+                self.crawl_chunk()
+            elif producing:
+                self.engine.sleep(1)  # more chunks to come
+            else:
+                self.come_back(timeout)
+                break
+
+    def come_back(self, timeout):
+        """
+        Leaves the chunks the other shards are working on to them, instead of waiting, but
+        dispatches a shard for when the oldest claim expires, in case its shard died.
+        """
+        claimed = CrawlChunk.in_progress(self.crawldomain).order_by('claimed').values_list('claimed', flat=True).first()
+        if claimed is None:
+            return
+        countdown = (claimed + timedelta(seconds=timeout) - timezone.now()).total_seconds()
+        crawl_shard_task.apply_async((self.crawldomain.pk, self.target_label, not self.incremental),
+                                     countdown=max(1, int(countdown) + 1))
+
+    def crawl_chunk(self):
+        """
+        Downloads and consolidates the urls of the claimed chunk.
+        """
+        # chunks only hold urls that need to be crawled, the validators make the requests conditional
+        self.validators = {}
+        if self.incremental:
+            for url, (validators, lastscraped, plan) in CrawlPage.state_for(self.chunk.url_list).iteritems():
+                if plan == self.plan.digest:
+                    self.validators[url] = validators
+        self.producer_task = self.engine.spawn(self.producer)
+        self.scheduler_task = self.engine.spawn(self.scheduler)
+        self.pipeline()
+        self.scheduler_task.get()
+        self.producer_task.get()
+        if not self.stopped:
+            self.chunk.finish()
+            self.metrics.incr('chunks')
+
+    def collect_urls(self):
+        for url in self.chunk.url_list:
+            if self.stopped:
+                break
+            self.urlqueue.put(Job(url, validators=self.validators.get(url, None)))
@@ -0,0 +1,16 @@
+# -*-*- encoding: utf-8 -*-*-
+import pytest
+from django.core.cache import cache
+from ..models import CrawlConfig
+from .factories import CrawlConfigFactory
+
+
+@pytest.fixture
+def useragent(db):
+    CrawlConfigFactory(key='USERAGENT', value='screep').save()
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    CrawlConfig._snapshot = None
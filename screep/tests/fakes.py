@@ -0,0 +1,52 @@
+# -*-*- encoding: utf-8 -*-*-
+from datetime import timedelta
+
+
+class FakeResponse(object):
+    """
+    Minimal stand-in for a streamed requests response. With `error` set, reading the
+    body raises it after the content.
+    """
+
+    def __init__(self, content='', status_code=200, headers=None, error=None):
+        self.content = content
+        self.error = error
+        self.status_code = status_code
+        self.headers = {'content-type': 'text/html'}
+        self.headers.update(headers or {})
+        self.elapsed = timedelta(seconds=0)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for i in xrange(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """
+    Session that returns canned responses and remembers the request headers.
+    Takes either a single response or a dictionary mapping urls to responses. A response
+    that is an exception is raised instead.
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.headers = None
+        self.requested = []
+
+    def get(self, url, **kwargs):
+        self.headers = kwargs.get('headers')
+        self.requested.append(url)
+        response = self.responses
+        if isinstance(response, dict):
+            response = response.get(url) or FakeResponse(status_code=404)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,9 @@
+# -*-*- encoding: utf-8 -*-*-
+from django.db import models
+
+
+class ScrapedItem(models.Model):
+    """Target model used to store scraped content in the tests."""
+
+    url = models.CharField(max_length=255, null=False, blank=False, db_index=True, unique=True)
+    title = models.CharField(max_length=255, default='')
@@ -50,4 +50,7 @@ INSTALLED_APPS = (
     'django.contrib.staticfiles',
     'django.contrib.sites',
     'screep',
+    'screep.tests',
 )
+
+SCREEP_TARGET_MODEL = 'tests.ScrapedItem'
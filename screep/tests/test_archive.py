@@ -0,0 +1,104 @@
+# -*-*- encoding: utf-8 -*-*-
+import multiprocessing
+import os
+import zlib
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from ..archive import PageArchive, get_archive
+from ..extraction import ExtractionPlan, fingerprint
+from ..models import CrawlDomain, CrawlPage, DomainAttributes
+from .models import ScrapedItem
+
+
+def test_archive_keeps_latest_copy(tmpdir):
+    archive = PageArchive(str(tmpdir), 'foo.com', segment_size=1)
+    archive.append('http://foo.com/a', '<html>a</html>' * 10, 'utf-8')
+    archive.append(u'http://foo.com/caf\xe9', '<html>b</html>')
+    archive.append('http://foo.com/a', '<html>new a</html>')
+    assert archive.get('http://foo.com/a') == ('<html>new a</html>', None)
+    assert archive.get(u'http://foo.com/caf\xe9') == ('<html>b</html>', None)
+    assert archive.get('http://foo.com/missing') is None
+    archive.close()
+    # every record fills a segment of its own
+    assert [n for writer, n in archive.segments()] == [0, 1, 2]
+    reopened = PageArchive(str(tmpdir), 'foo.com', segment_size=1)
+    reopened.append('http://foo.com/c', '<html>c</html>')
+    latest = sorted((url, encoding) for url, body, encoding in reopened.latest())
+    assert latest == [('http://foo.com/a', None), ('http://foo.com/c', None), ('http://foo.com/caf\xc3\xa9', None)]
+
+
+def append_pages(root, first):
+    archive = PageArchive(root, 'foo.com', segment_size=4096)
+    for i in xrange(first, first + 300):
+        archive.append('http://foo.com/%d' % i, '<html>%d</html>' % i * 20)
+    archive.close()
+
+
+def test_archive_written_by_several_processes(tmpdir):
+    processes = [multiprocessing.Process(target=append_pages, args=(str(tmpdir), i * 300)) for i in xrange(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    archive = PageArchive(str(tmpdir), 'foo.com')
+    assert len(archive.writers()) == 4
+    pages = dict((url, zlib.decompress(body)) for url, body, encoding in archive.latest())
+    assert len(pages) == 1200
+    assert all(body == '<html>%s</html>' % url[15:] * 20 for url, body in pages.iteritems())
+    assert archive.get('http://foo.com/1000') == ('<html>1000</html>' * 20, None)
+
+
+def test_archive_compaction(tmpdir, settings):
+    archive = PageArchive(str(tmpdir), 'foo.com', segment_size=4096)
+    for i in xrange(300):
+        archive.append('http://foo.com/%d' % (i % 100), '<html>%d</html>' % i * 20)
+    # not while the archive is being written
+    assert archive.compact() is None
+    archive.close()
+    assert archive.compact() == 100
+    assert archive.writers() == []
+    assert len(archive.writers('.sorted')) == 1
+    assert all(writer.startswith('compacted-') for writer, n in archive.segments())
+    for i in xrange(100):
+        assert archive.get('http://foo.com/%d' % i) == ('<html>%d</html>' % (i + 200) * 20, None)
+    assert archive.get('http://foo.com/100') is None
+    # pages archived since are found next to the compacted ones
+    archive.append('http://foo.com/7', '<html>new</html>')
+    archive.close()
+    assert archive.get('http://foo.com/7') == ('<html>new</html>', None)
+    assert archive.get('http://foo.com/8') == ('<html>208</html>' * 20, None)
+    assert len(list(archive.latest())) == 100
+    settings.SCREEP_ARCHIVE = str(tmpdir)
+    call_command('compactarchive', 'foo.com')
+    assert archive.writers() == []
+    assert archive.get('http://foo.com/7') == ('<html>new</html>', None)
+
+
+def test_get_archive(tmpdir, settings):
+    settings.SCREEP_ARCHIVE = None
+    assert get_archive('foo.com') is None
+    settings.SCREEP_ARCHIVE = str(tmpdir)
+    assert get_archive('foo.com:8080').path == str(tmpdir.join('foo.com_8080'))
+
+
+@pytest.mark.django_db
+def test_reextract_command(tmpdir, settings):
+    settings.SCREEP_ARCHIVE = str(tmpdir)
+    domain = CrawlDomain.objects.create(name='foo', domain='foo.com')
+    DomainAttributes.objects.create(domain=domain, key='title', xpath='//body/h1/text()')
+    archive = get_archive('foo.com')
+    for i in xrange(150):
+        archive.append('http://foo.com/%d' % i, '<html><body><h1>Item %d</h1></body></html>' % i)
+    archive.close()
+    # a record cut short, as by a crash, counts as one failure
+    segment = archive.segment_path(archive.writer, archive.segment)
+    with open(segment, 'r+b') as f:
+        f.truncate(os.path.getsize(segment) - 10)
+    call_command('reextract', 'foo.com', processes=2)
+    assert ScrapedItem.objects.count() == 149
+    assert ScrapedItem.objects.get(url='http://foo.com/42').title == 'Item 42'
+    digest = ExtractionPlan({'title': '//body/h1/text()'}).digest
+    assert CrawlPage.objects.get(url='http://foo.com/42').fingerprint == fingerprint({'title': 'Item 42'}, 'tests.ScrapedItem', digest)
+    with pytest.raises(CommandError):
+        call_command('reextract', 'bar.com')
@@ -0,0 +1,55 @@
+# -*-*- encoding: utf-8 -*-*-
+import pytest
+from django.db import connection
+from .. import db
+from ..db import bulk_upsert
+from ..models import CrawlDomain, CrawlPage
+from .models import ScrapedItem
+
+
+pytestmark = pytest.mark.django_db
+
+
+def upsert_items():
+    ScrapedItem.objects.create(url='http://foo.com/1', title='old')
+    ScrapedItem.objects.create(url='http://foo.com/2', title='old')
+    items = [ScrapedItem(url='http://foo.com/%d' % i, title='new %d' % i) for i in (1, 3)]
+    bulk_upsert(ScrapedItem, items, 'url', ['title'])
+    return dict(ScrapedItem.objects.values_list('url', 'title'))
+
+
+def test_native_upsert():
+    assert upsert_items() == {
+        'http://foo.com/1': 'new 1',
+        'http://foo.com/2': 'old',
+        'http://foo.com/3': 'new 3',
+    }
+
+
+def test_fallback_upsert(monkeypatch):
+    monkeypatch.setattr(db, 'supports_upsert', lambda connection: False)
+    assert upsert_items() == {
+        'http://foo.com/1': 'new 1',
+        'http://foo.com/2': 'old',
+        'http://foo.com/3': 'new 3',
+    }
+
+
+def test_fallback_upsert_stays_below_parameter_limit(monkeypatch):
+    monkeypatch.setattr(db, 'supports_upsert', lambda connection: False)
+    domain = CrawlDomain.objects.create(name='foo', domain='foo.com')
+    CrawlPage.objects.bulk_create([CrawlPage(domain=domain, url='http://foo.com/%d' % i) for i in xrange(150)])
+    executed = []
+    cursor = connection.cursor
+
+    def counting_cursor():
+        c = cursor()
+        execute = c.execute
+        c.execute = lambda sql, params=None: executed.append(len(params or ())) or execute(sql, params)
+        return c
+    monkeypatch.setattr(connection, 'cursor', counting_cursor)
+    pages = [CrawlPage(domain=domain, url='http://foo.com/%d' % i, etag='"%d"' % i, content_hash='%d' % i) for i in xrange(150)]
+    bulk_upsert(CrawlPage, pages, 'url', ['etag', 'last_modified', 'content_hash', 'fingerprint', 'plan'])
+    # sqlite before 3.24, where the fallback runs, takes no more than 999 parameters
+    assert executed and max(executed) <= 999
+    assert CrawlPage.objects.get(url='http://foo.com/149').etag == '"149"'
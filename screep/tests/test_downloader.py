@@ -0,0 +1,154 @@
+# -*-*- encoding: utf-8 -*-*-
+import gzip
+import io
+from datetime import datetime
+import pytest
+import requests
+from django.utils import timezone
+from requests.packages.urllib3.exceptions import ReadTimeoutError
+from ..downloader import build_session, RobotsDownloader, SitemapDownloader, WebpageDownloader
+from ..exceptions import CrawlerException
+from ..models import PageValidators
+from .fakes import FakeResponse, FakeSession
+
+
+def test_session_is_pooled():
+    s = build_session(7)
+    adapter = s.get_adapter('http://foo.com/')
+    assert adapter is s.get_adapter('https://foo.com/')
+    assert adapter._pool_maxsize == 7
+    assert 'Connection' not in s.headers or s.headers['Connection'] != 'close'
+    s.close()
+
+
+def test_webpage_conditional_get(useragent):
+    session = FakeSession(FakeResponse(status_code=304))
+    d = WebpageDownloader(xpaths={'title': '//title/text()'}, session=session)
+    d.download('http://foo.com/', PageValidators('"abc"', 'Mon, 01 Dec 2014 10:00:00 GMT', ''))
+    assert session.headers['If-None-Match'] == '"abc"'
+    assert session.headers['If-Modified-Since'] == 'Mon, 01 Dec 2014 10:00:00 GMT'
+    assert d.not_modified
+    assert d.data == {}
+
+
+def test_webpage_unchanged_body_is_skipped(useragent):
+    html = '<html><head><title>Foo</title></head><body></body></html>'
+    session = FakeSession(FakeResponse(html, headers={'etag': '"abc"'}))
+    d = WebpageDownloader(xpaths={'title': '//title/text()'}, session=session)
+    d.download('http://foo.com/')
+    assert not d.not_modified
+    assert d.data == {'title': 'Foo'}
+    assert d.validators.etag == '"abc"'
+    d.download('http://foo.com/', PageValidators('', '', d.validators.content_hash))
+    assert d.not_modified
+    assert d.data == {}
+
+
+def test_webpage_overloaded(useragent):
+    session = FakeSession(FakeResponse('<html><head><title>Busy</title></head></html>', status_code=503))
+    d = WebpageDownloader(xpaths={'title': '//title/text()'}, session=session)
+    with pytest.raises(CrawlerException):
+        d.download('http://foo.com/')
+    assert d.status_code == 503
+    assert d.error == 'overloaded'
+    assert d.data == {}
+
+
+@pytest.mark.parametrize('error, kind', [
+    (requests.exceptions.ConnectTimeout('connect timed out'), 'timeout'),
+    (requests.ConnectionError('connection refused'), 'connection'),
+    (FakeResponse('<html><head>', error=requests.ConnectionError(ReadTimeoutError(None, 'http://foo.com/', 'read timed out'))), 'timeout'),
+    (FakeResponse('<html><head>', error=requests.exceptions.ChunkedEncodingError('connection reset')), 'connection'),
+], ids=['connect-timeout', 'connect', 'read-timeout', 'read'])
+def test_webpage_errors(useragent, error, kind):
+    d = WebpageDownloader(xpaths={'title': '//title/text()'}, head=True, session=FakeSession(error))
+    with pytest.raises(CrawlerException):
+        d.download('http://foo.com/')
+    assert d.error == kind
+    assert d.metrics.counters['errors.' + kind] == 1
+
+
+def test_sitemap_collects_lastmod(useragent):
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <url><loc>http://foo.com/a</loc><lastmod>2014-11-05</lastmod></url>
+  <url><loc>http://foo.com/b</loc></url>
+</urlset>"""
+    d = SitemapDownloader(session=FakeSession(FakeResponse(xml, headers={'content-type': 'text/xml'})))
+    d.download('http://foo.com/sitemap.xml')
+    assert d.urls == [('http://foo.com/a', datetime(2014, 11, 5, tzinfo=timezone.utc)), ('http://foo.com/b', None)]
+
+
+def test_sitemap_streams_gzipped_content(useragent):
+    xml = '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s</urlset>' % ''.join(
+        '<url><loc>http://foo.com/%d</loc></url>' % i for i in xrange(5000))
+    buf = io.BytesIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(xml)
+    f.close()
+    found = []
+    response = FakeResponse(buf.getvalue(), headers={'content-type': 'application/octet-stream'})
+    d = SitemapDownloader(session=FakeSession(response), callback=lambda loc, lastmod: found.append(loc))
+    d.download('http://foo.com/sitemap.xml.gz')
+    assert len(found) == 5000
+    assert found[-1] == 'http://foo.com/4999'
+    assert d.urls == []
+
+
+def test_sitemap_read_before_urls_are_handed_on(useragent):
+    xml = '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s</urlset>' % ''.join(
+        '<url><loc>http://foo.com/%d</loc></url>' % i for i in xrange(5000))
+    response = FakeResponse(xml, headers={'content-type': 'text/xml'})
+    served = []
+
+    def iter_content(chunk_size=1, decode_unicode=False):
+        for i in xrange(0, len(xml), chunk_size):
+            served.append(i)
+            yield xml[i:i + chunk_size]
+    response.iter_content = iter_content
+    found = []
+    # a slow consumer must not keep the connection waiting
+    d = SitemapDownloader(session=FakeSession(response), callback=lambda loc, lastmod: found.append(len(served)))
+    d.download('http://foo.com/sitemap.xml')
+    assert len(found) == 5000
+    assert found[0] == len(served) > 1
+
+
+def test_webpage_head_only(useragent):
+    html = '<html><head><title>Caf\xe9</title></head><body>%s</body></html>' % ('x' * 100000)
+    response = FakeResponse(html, headers={'content-type': 'text/html; charset=ISO-8859-1'})
+    served = []
+
+    def iter_content(chunk_size=1, decode_unicode=False):
+        for chunk in (html[:20], html[20:2048], html[2048:]):
+            served.append(chunk)
+            yield chunk
+    response.iter_content = iter_content
+    d = WebpageDownloader(xpaths={'title': '//title/text()'}, head=True, session=FakeSession(response))
+    d.download('http://foo.com/')
+    assert d.data == {'title': 'Caf\xc3\xa9'}
+    assert len(served) == 2
+
+
+def test_robots_are_cached(useragent):
+    robots = 'User-agent: *\nDisallow: /private\nCrawl-delay: 2\nSitemap: http://foo.com/sitemap.xml\n'
+    session = FakeSession({'http://foo.com/robots.txt': FakeResponse(robots, headers={'cache-control': 'max-age=600'})})
+    d = RobotsDownloader(session=session)
+    d.get_for_domain('foo.com')
+    assert d.sitemaps == ['http://foo.com/sitemap.xml']
+    assert d.delay == 2
+    assert not d.banned
+    assert not d.allowed('http://foo.com/private/1')
+    assert 0 < d.rules.ttl <= 600
+    assert RobotsDownloader.is_allowed('http://foo.com/public', session=session)
+    assert not RobotsDownloader.is_allowed('foo.com/private', session=session)
+    assert session.requested == ['http://foo.com/robots.txt']
+
+
+def test_robots_not_cached_when_forbidden_by_headers(useragent):
+    session = FakeSession(FakeResponse('User-agent: *\nDisallow: /\n', headers={'cache-control': 'no-cache'}))
+    for i in xrange(2):
+        d = RobotsDownloader(session=session)
+        d.get_for_domain('foo.com')
+        assert d.banned
+    assert len(session.requested) == 2
@@ -0,0 +1,38 @@
+# -*-*- encoding: utf-8 -*-*-
+import pytest
+from ..engines import get_engine, GeventEngine, ThreadedEngine
+from ..exceptions import CrawlerException
+
+
+def test_get_engine(settings):
+    assert isinstance(get_engine(), GeventEngine)
+    settings.SCREEP_ENGINE = 'threaded'
+    assert isinstance(get_engine(), ThreadedEngine)
+    assert isinstance(get_engine('screep.engines.GeventEngine'), GeventEngine)
+    with pytest.raises(CrawlerException):
+        get_engine('foo.Bar')
+
+
+@pytest.mark.parametrize('engine', [GeventEngine(), ThreadedEngine()], ids=['gevent', 'threaded'])
+def test_engine_primitives(engine):
+    q = engine.queue(2)
+    results = []
+
+    def consume():
+        for i in iter(q.get, StopIteration):
+            results.append(i)
+        return len(results)
+
+    consumer = engine.spawn(consume)
+    p = engine.pool(3)
+    for i in xrange(10):
+        p.spawn(q.put, i)
+    p.join()
+    q.put(StopIteration)
+    assert consumer.get() == 10
+    assert sorted(results) == range(10)
+
+    def fail():
+        raise ValueError('boom')
+    with pytest.raises(ValueError):
+        engine.spawn(fail).get()
@@ -0,0 +1,68 @@
+# -*-*- encoding: utf-8 -*-*-
+import pytest
+from ..exceptions import CrawlerException
+from ..engines import GeventEngine, ThreadedEngine
+from ..extraction import ExtractionPlan, ExtractionPool, fingerprint
+from ..models import CrawlDomain, DomainAttributes
+from ..utils import charset_from_content_type
+
+
+def test_plan_extracts_first_match():
+    plan = ExtractionPlan({'title': '//title/text()', 'missing': '//h1/text()', 'count': 'count(//p)'})
+    data = plan.extract('<html><head><title>Foo</title></head><body><p>a</p><p>b</p></body></html>')
+    assert data == {'title': 'Foo', 'missing': '', 'count': '2.0'}
+
+
+@pytest.mark.parametrize('charset', ['EUC-JP', 'EUC-KR', 'ISO-2022-JP', 'Shift_JIS'])
+def test_plan_extracts_non_utf8_charsets(charset):
+    title = u'\u65e5\u672c' if charset != 'EUC-KR' else u'\ud55c\uad6d'
+    html = u'<html><head><title>%s</title></head><body></body></html>' % title
+    plan = ExtractionPlan({'title': '//title/text()'})
+    encoding = charset_from_content_type('text/html; charset=' + charset)
+    assert plan.extract(html.encode(encoding), encoding) == {'title': title.encode('utf-8')}
+
+
+def test_fingerprint():
+    a = fingerprint({'title': 'Foo', 'summary': u'caf\xe9'})
+    assert len(a) == 16
+    assert a == fingerprint({'summary': u'caf\xe9'.encode('utf-8'), 'title': 'Foo'})
+    assert a != fingerprint({'title': 'Foo', 'summary': 'cafe'})
+    assert fingerprint({'a': 'b', 'c': ''}) != fingerprint({'a': '', 'c': 'b'})
+    assert fingerprint({'title': 'Foo'}, 'tests.ScrapedItem') != fingerprint({'title': 'Foo'}, 'tests.Other')
+
+
+def test_plan_rejects_invalid_xpath():
+    with pytest.raises(CrawlerException):
+        ExtractionPlan({'title': '//title[text('})
+
+
+@pytest.mark.django_db
+def test_plan_is_cached_until_attributes_change():
+    domain = CrawlDomain.objects.create(name='foo', domain='foo.com')
+    attr = DomainAttributes.objects.create(domain=domain, key='title', xpath='//title/text()')
+    plan = ExtractionPlan.for_domain(domain)
+    assert ExtractionPlan.for_domain(domain) is plan
+    attr.xpath = '//h1/text()'
+    attr.save()
+    plan = ExtractionPlan.for_domain(domain)
+    assert plan.xpaths == {'title': '//h1/text()'}
+    attr.delete()
+    assert ExtractionPlan.for_domain(domain).xpaths == {}
+
+
+@pytest.mark.parametrize('engine', [GeventEngine(), ThreadedEngine()], ids=['gevent', 'threaded'])
+def test_pool_extracts_in_worker_processes(engine):
+    pool = ExtractionPool(ExtractionPlan({'title': '//title/text()'}), 2, engine)
+    try:
+        assert pool.xpaths == {'title': '//title/text()'}
+        assert pool.extract('<html><head><title>Caf\xe9</title></head></html>', 'iso-8859-1') == {'title': 'Caf\xc3\xa9'}
+    finally:
+        pool.close()
+    # errors in the workers come back with their message
+    pool = ExtractionPool(ExtractionPlan({'title': '$undefined'}), 1, engine)
+    try:
+        with pytest.raises(CrawlerException) as e:
+            pool.extract('<html></html>')
+        assert 'Undefined variable' in e.value.message
+    finally:
+        pool.close()
@@ -0,0 +1,70 @@
+# -*-*- encoding: utf-8 -*-*-
+import threading
+from ..frontier import BloomFilter, SeenUrls, SitemapProgress
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(10000, 0.01)
+    assert bloom.hashes == 7
+    assert len(bloom.array) < 12000
+    for i in xrange(10000):
+        assert bloom.add('http://foo.com/%d' % i) or i > 0
+    assert all('http://foo.com/%d' % i in bloom for i in xrange(10000))
+    false_positives = sum(1 for i in xrange(10000) if 'http://bar.com/%d' % i in bloom)
+    assert false_positives < 200
+    assert not bloom.add('http://foo.com/1')
+
+
+def test_seen_urls_switch_to_bloom_filter():
+    seen = SeenUrls(max_exact=100, capacity=1000)
+    for i in xrange(100):
+        assert seen.add('http://foo.com/%d' % i)
+    assert not seen.add(u'http://foo.com/1')
+    assert seen.bloom is None
+    assert seen.add('http://foo.com/100')
+    assert seen.bloom is not None
+    assert seen.urls is None
+    assert not seen.add('http://foo.com/42')
+    assert seen.add('http://foo.com/101')
+    assert len(seen) == 102
+
+
+def test_seen_urls_on_threads():
+    seen = SeenUrls(max_exact=20000, capacity=200000)
+    new = []
+
+    def add(offset):
+        count = 0
+        for i in xrange(40000):
+            if seen.add('http://foo.com/%d' % ((offset + i) % 60000)):
+                count += 1
+        new.append(count)
+    threads = [threading.Thread(target=add, args=(i * 15000,)) for i in xrange(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(new) == 4
+    assert seen.bloom is not None
+    # every url counted as new once, bar the odd false positive
+    assert 59900 <= sum(new) <= 60000
+
+
+def test_sitemap_progress():
+    progress = SitemapProgress(['done.xml'])
+    for sitemap in ('index.xml', 'a.xml', 'b.xml', 'broken.xml'):
+        progress.started(sitemap)
+    progress.parsed('index.xml', complete=False)
+    progress.queued('a.xml')
+    progress.queued('a.xml')
+    progress.parsed('a.xml')
+    progress.parsed('b.xml')
+    progress.queued('broken.xml')
+    progress.parsed('broken.xml', complete=False)
+    assert progress.done == set(['done.xml', 'b.xml'])
+    progress.finished('a.xml')
+    assert 'a.xml' not in progress.done
+    progress.finished('a.xml')
+    progress.finished('broken.xml')
+    assert progress.done == set(['done.xml', 'a.xml', 'b.xml'])
+    assert progress.pending == {}
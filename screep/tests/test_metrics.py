@@ -0,0 +1,57 @@
+# -*-*- encoding: utf-8 -*-*-
+import socket
+import pytest
+from ..exceptions import CrawlerException
+from ..metrics import get_sink, Histogram, LoggingSink, MemorySink, Metrics, StatsdSink
+
+
+def test_histogram():
+    h = Histogram()
+    for ms in (5, 8, 20, 40, 3200):
+        h.add(ms)
+    assert h.count == 5
+    assert h.mean == 654.6
+    assert h.percentile(50) == 25
+    assert h.percentile(95) == 3200
+    assert h.max == 3200
+
+
+def test_metrics_pass_measurements_to_sink():
+    sink = MemorySink()
+    metrics = Metrics('foo.com', sink)
+    metrics.timing('fetch', 3.2)
+    metrics.incr('status.200')
+    metrics.incr('status.200')
+    with metrics.timer('parse'):
+        pass
+    metrics.flush()
+    assert metrics.histograms['fetch'].max == 3200
+    assert metrics.histograms['parse'].count == 1
+    assert metrics.counters == {'status.200': 2}
+    assert sink.timings[0] == ('foo.com', 'fetch', 3200)
+    assert sink.counts == [('foo.com', 'status.200', 1)] * 2
+    assert sink.flushed == [metrics]
+
+
+def test_statsd_sink():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(5)
+    sink = StatsdSink('127.0.0.1', server.getsockname()[1])
+    metrics = Metrics('foo.com', sink)
+    metrics.timing('fetch', 0.25)
+    metrics.incr('bytes', 512)
+    assert sink.buffer
+    metrics.flush()
+    assert server.recv(4096) == 'screep.foo_com.fetch:250.000|ms\nscreep.foo_com.bytes:512|c'
+    server.close()
+
+
+def test_get_sink(settings):
+    assert isinstance(get_sink(), LoggingSink)
+    settings.SCREEP_METRICS = 'statsd'
+    settings.SCREEP_METRICS_OPTIONS = {'prefix': 'crawler'}
+    assert get_sink().prefix == 'crawler'
+    assert isinstance(get_sink('screep.metrics.MemorySink'), MemorySink)
+    with pytest.raises(CrawlerException):
+        get_sink('foo.Bar')
@@ -1,8 +1,10 @@
 # -*-*- encoding: utf-8 -*-*-
 import pytest
+from datetime import timedelta
+from django.utils import timezone
 from django.core.cache import cache
 from ..exceptions import ConfigException
-from ..models import CrawlDomain, CrawlConfig
+from ..models import CrawlChunk, CrawlDomain, CrawlConfig, ConfigSnapshot
 from .factories import CrawlDomainFactory, CrawlConfigFactory
 
 
@@ -43,3 +45,62 @@ def test_crawlconfig_should_raise_on_unknown_key():
         CrawlConfig.value_for_key('unknown', raise_on_dne=False)
     except ConfigException:
         pytest.fail("Should not raise ConfigException")
+
+
+def test_crawldomain_stale_domains():
+    now = timezone.now()
+    fresh = CrawlDomain.objects.create(name='fresh', domain='fresh.com', lastcrawl=now - timedelta(hours=1))
+    stale = CrawlDomain.objects.create(name='stale', domain='stale.com', lastcrawl=now - timedelta(hours=25))
+    CrawlDomain.objects.create(name='off', domain='off.com', status=CrawlDomain.STATUS_TYPES.disabled)
+    assert [d.domain for d in CrawlDomain.get_stale_domains()] == ['stale.com']
+    fresh.ttl = 1
+    fresh.save(update_fields=['ttl'])
+    assert [d.domain for d in CrawlDomain.iter_stale_domains(chunk_size=1)] == ['stale.com', 'fresh.com']
+    assert stale.claim()
+    assert [d.domain for d in CrawlDomain.get_stale_domains()] == ['fresh.com']
+    copy = CrawlDomain.objects.get(pk=fresh.pk)
+    assert fresh.claim()
+    assert not copy.claim()
+
+
+def test_crawlconfig_snapshot():
+    CrawlConfig.objects.create(key='TIMEOUT', value='2m')
+    CrawlConfig.objects.create(key='QUEUESIZE', value='50')
+    snapshot = CrawlConfig.snapshot()
+    assert CrawlConfig.snapshot() is snapshot
+    assert snapshot.get_duration('TIMEOUT', 15) == 120
+    assert snapshot.get_int('QUEUESIZE', 1000) == 50
+    assert snapshot.get_int('TIMEOUT', 15) == 15
+    assert snapshot.get('UNKNOWN', 'foo') == 'foo'
+    with pytest.raises(ConfigException):
+        snapshot.get('UNKNOWN', raise_on_dne=True)
+    # saving reloads the snapshot of this process right away
+    CrawlConfig.objects.filter(key='QUEUESIZE').update(value='60')
+    CrawlConfig.objects.create(key='POOLSIZE', value='4')
+    assert CrawlConfig.snapshot().get_int('QUEUESIZE') == 60
+    # other processes notice the new version once the check interval has passed
+    snapshot = CrawlConfig.snapshot()
+    CrawlConfig.objects.filter(key='QUEUESIZE').update(value='70')
+    cache.set(CrawlConfig.VERSION_KEY, 'other', None)
+    assert CrawlConfig.snapshot() is snapshot
+    snapshot.checked -= CrawlConfig.CHECK_INTERVAL
+    assert CrawlConfig.snapshot().get_int('QUEUESIZE') == 70
+
+
+def test_config_durations():
+    snapshot = ConfigSnapshot({'a': '90', 'b': '90s', 'c': '1.5h', 'd': '1d', 'e': 'soon'}, 1)
+    assert [snapshot.get_duration(k, 0) for k in 'abcdef'] == [90, 90, 5400, 86400, 0, 0]
+
+
+def test_crawlchunk_claim_next():
+    domain = CrawlDomain.objects.create(name='foo', domain='foo.com')
+    first = CrawlChunk.objects.create(domain=domain, urls='http://a/1\nhttp://a/2\n')
+    second = CrawlChunk.objects.create(domain=domain, urls='http://a/3')
+    now = timezone.now()
+    chunk = CrawlChunk.claim_next(domain, 3600, now)
+    assert chunk.pk == first.pk and chunk.url_list == ['http://a/1', 'http://a/2']
+    assert CrawlChunk.claim_next(domain, 3600, now).pk == second.pk
+    assert CrawlChunk.claim_next(domain, 3600, now) is None
+    chunk.finish()
+    # claims of workers that went away expire
+    assert CrawlChunk.claim_next(domain, 3600, now + timedelta(hours=2)).pk == second.pk
@@ -0,0 +1,27 @@
+# -*-*- encoding: utf-8 -*-*-
+import pytest
+from ..exceptions import CrawlerException
+from ..models import CrawlDomain, DomainAttributes
+from ..registry import TargetRegistry
+from .models import ScrapedItem
+
+
+def test_registry_resolves_declared_models(settings):
+    registry = TargetRegistry()
+    settings.SCREEP_TARGET_MODELS = {'bar.com': 'screep.CrawlPage'}
+    assert registry.label_for('foo.com') == 'tests.ScrapedItem'
+    assert registry.label_for('bar.com') == 'screep.CrawlPage'
+    registry.register(ScrapedItem, domain='bar.com')
+    assert registry.model_for('bar.com') is ScrapedItem
+    with pytest.raises(CrawlerException):
+        registry.get_model('tests.Unknown')
+    with pytest.raises(CrawlerException):
+        registry.get_model('screep.CrawlDomain')  # no url field
+
+
+@pytest.mark.django_db
+def test_registry_autodetects_model(settings):
+    del settings.SCREEP_TARGET_MODEL
+    domain = CrawlDomain.objects.create(name='foo', domain='foo.com')
+    DomainAttributes.objects.create(domain=domain, key='title', xpath='//title/text()')
+    assert TargetRegistry().model_for('foo.com') is ScrapedItem
@@ -0,0 +1,492 @@
+# -*-*- encoding: utf-8 -*-*-
+import os
+import signal
+from datetime import timedelta
+import gevent
+import pytest
+import requests
+from billiard.pool import SIG_SOFT_TIMEOUT
+from celery.exceptions import SoftTimeLimitExceeded
+from django.core.cache import cache
+from django.utils import timezone
+from .. import tasks
+from ..engines import ThreadedEngine
+from ..extraction import ExtractionPlan, fingerprint
+from ..models import CrawlCheckpoint, CrawlChunk, CrawlConfig, CrawlDomain, CrawlPage, DomainAttributes
+from .fakes import FakeResponse, FakeSession
+from .models import ScrapedItem
+
+
+def sitemap(*urls):
+    return '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s</urlset>' % ''.join(
+        '<url><loc>%s</loc></url>' % url for url in urls)
+
+
+def page(title):
+    return '<html><head><title>%s</title></head><body><p>%s</p></body></html>' % (title, title)
+
+
+@pytest.fixture
+def site(useragent, monkeypatch):
+    CrawlConfig.objects.create(key='REQUESTRATE', value='0')
+    domain = CrawlDomain.objects.create(name='foo', domain='foo.com')
+    DomainAttributes.objects.create(domain=domain, key='title', xpath='//title/text()')
+    responses = {
+        'http://foo.com/robots.txt': FakeResponse('User-agent: *\nSitemap: http://foo.com/sitemap.xml\n', headers={'content-type': 'text/plain'}),
+        'http://foo.com/sitemap.xml': FakeResponse(sitemap(*['http://foo.com/%d' % i for i in xrange(150)]), headers={'content-type': 'text/xml'}),
+    }
+    for i in xrange(150):
+        responses['http://foo.com/%d' % i] = FakeResponse(page('Item %d' % i))
+    session = FakeSession(responses)
+    monkeypatch.setattr(tasks, 'build_session', lambda *args, **kwargs: session)
+    return domain, session
+
+
+def test_crawl_domain(site):
+    domain, session = site
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    crawler.start()
+    assert ScrapedItem.objects.count() == 150
+    assert ScrapedItem.objects.get(url='http://foo.com/42').title == 'Item 42'
+    assert CrawlPage.objects.filter(domain=domain, lastscraped__isnull=False).count() == 150
+
+
+def test_crawl_with_small_queue(site):
+    domain, session = site
+    CrawlConfig.objects.create(key='QUEUESIZE', value='5')
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    assert crawler.urlqueue.maxsize == 5
+    crawler.start()
+    assert ScrapedItem.objects.count() == 150
+
+
+def test_can_use_head(site):
+    domain, session = site
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    assert crawler._can_use_head({'title': '//title/text()', 'desc': '//meta[@name="description"]/@content'})
+    assert not crawler._can_use_head({'title': '//div[@class="header"]/text()'})
+    assert not crawler._can_use_head({'title': '//title/text() | //h1/text()'})
+
+
+def test_dispatch_fills_free_slots(db, monkeypatch):
+    domains = [CrawlDomain.objects.create(name='foo', domain='foo%d.com' % i) for i in xrange(4)]
+    dispatched = []
+    DomainAttributes.objects.create(domain=domains[0], key='title', xpath='//title/text()')
+    monkeypatch.setattr(tasks.crawl_task, 'apply_async', lambda args, **kwargs: dispatched.append(CrawlDomain.objects.get(pk=args[0]).domain))
+    CrawlConfig.objects.create(key='MAXDOMAINS', value='2')
+    cc = tasks.CrawlerControl()
+    cc.start()
+    assert dispatched == ['foo0.com', 'foo1.com']
+    assert cc.slots.taken() == 2
+    # a claimed domain is not dispatched again
+    cc.slots.release(domains[0].pk)
+    cc.start()
+    assert dispatched == ['foo0.com', 'foo1.com', 'foo2.com']
+    assert cc.slots.taken() == 2
+    # slots of crawls that never finished expire
+    CrawlDomain.objects.filter(pk=domains[1].pk).update(dispatched=timezone.now() - timedelta(days=2))
+    assert cc.slots.taken() == 1
+    tasks.crawl_done(domains[2].pk)
+    assert dispatched == ['foo0.com', 'foo1.com', 'foo2.com', 'foo3.com']
+    assert set(CrawlDomain.objects.filter(dispatched__isnull=False).values_list('domain', flat=True)) == set(['foo1.com', 'foo3.com'])
+
+
+def test_dispatch_skips_domains_in_flight(db, monkeypatch):
+    domain = CrawlDomain.objects.create(name='foo', domain='foo.com', ttl=1)
+    DomainAttributes.objects.create(domain=domain, key='title', xpath='//title/text()')
+    dispatched = []
+    monkeypatch.setattr(tasks.crawl_task, 'apply_async', lambda args, **kwargs: dispatched.append(args[0]))
+    cc = tasks.CrawlerControl()
+    cc.start()
+    # its interval passes while it is still being crawled
+    CrawlDomain.objects.filter(pk=domain.pk).update(next_crawl_at=timezone.now() - timedelta(hours=1))
+    cc.start()
+    assert dispatched == [domain.pk]
+    assert cc.slots.taken() == 1
+
+
+def test_dispatch_skips_misconfigured_domain(db, monkeypatch, settings):
+    broken = CrawlDomain.objects.create(name='foo', domain='broken.com')
+    CrawlDomain.objects.create(name='foo', domain='ok.com', lastcrawl=timezone.now() - timedelta(days=2))
+    DomainAttributes.objects.create(domain=broken, key='title', xpath='//title/text()')
+    settings.SCREEP_TARGET_MODELS = {'broken.com': 'tests.Missing'}
+    dispatched = []
+    monkeypatch.setattr(tasks.crawl_task, 'apply_async', lambda args, **kwargs: dispatched.append(CrawlDomain.objects.get(pk=args[0]).domain))
+    tasks.CrawlerControl().start()
+    assert dispatched == ['ok.com']
+    # it does not block the others, nor does it count as crawled
+    assert CrawlDomain.objects.get(domain='broken.com').next_crawl_at < timezone.now()
+
+
+def test_crawl_with_threaded_engine(site):
+    domain, session = site
+    crawler = tasks.CrawlerTask(domain, ScrapedItem, engine=ThreadedEngine())
+    crawler.start()
+    assert ScrapedItem.objects.count() == 150
+    assert CrawlPage.objects.filter(domain=domain, lastscraped__isnull=False).count() == 150
+
+
+def test_crawl_with_extraction_pool(site):
+    domain, session = site
+    CrawlConfig.objects.create(key='EXTRACTWORKERS', value='2')
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    crawler.start()
+    assert ScrapedItem.objects.get(url='http://foo.com/42').title == 'Item 42'
+    assert ScrapedItem.objects.count() == 150
+    assert crawler.extraction_pool is None
+
+
+def test_crawl_metrics(site, settings):
+    domain, session = site
+    settings.SCREEP_METRICS = 'memory'
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    crawler.start()
+    metrics = crawler.metrics
+    assert crawler.metrics.sink.flushed == [metrics]
+    assert metrics.counters['pages.scraped'] == 150
+    assert metrics.counters['status.200'] == 152
+    assert metrics.counters['db.rows'] == 300
+    assert metrics.counters['bytes'] > 150 * len(page('Item 0'))
+    assert metrics.histograms['fetch'].count == 150
+    for stage in ('robots', 'sitemap', 'parse', 'queue_wait', 'consolidate', 'crawl'):
+        assert metrics.histograms[stage].count > 0
+
+
+def test_crawl_fetches_duplicate_urls_once(site):
+    domain, session = site
+    session.responses['http://foo.com/robots.txt'].content += 'Sitemap: http://foo.com/sitemap2.xml\n'
+    session.responses['http://foo.com/sitemap2.xml'] = FakeResponse(sitemap('http://foo.com/1', 'http://foo.com/150'), headers={'content-type': 'text/xml'})
+    session.responses['http://foo.com/150'] = FakeResponse(page('Item 150'))
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    crawler.start()
+    assert ScrapedItem.objects.count() == 151
+    assert session.requested.count('http://foo.com/1') == 1
+    assert crawler.metrics.counters['urls.duplicate'] == 1
+
+
+def sitemap_index(*urls):
+    return '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s</sitemapindex>' % ''.join(
+        '<sitemap><loc>%s</loc></sitemap>' % url for url in urls)
+
+
+@pytest.mark.parametrize('engine', [None, ThreadedEngine()], ids=['gevent', 'threaded'])
+def test_crawl_nested_sitemaps(site, engine):
+    domain, session = site
+    responses = session.responses
+    responses['http://foo.com/robots.txt'].content = 'User-agent: *\nSitemap: http://foo.com/index.xml\n'
+    # the index lists itself, a nested index and a missing sitemap, the nested index lists 3 sitemaps
+    responses['http://foo.com/index.xml'] = FakeResponse(sitemap_index(
+        'http://foo.com/index.xml', 'http://foo.com/nested.xml', 'http://foo.com/missing.xml'), headers={'content-type': 'text/xml'})
+    responses['http://foo.com/nested.xml'] = FakeResponse(sitemap_index(
+        *['http://foo.com/sitemap%d.xml' % i for i in xrange(3)]), headers={'content-type': 'text/xml'})
+    responses['http://foo.com/missing.xml'] = FakeResponse('not found', status_code=404, headers={'content-type': 'text/plain'})
+    for i in xrange(3):
+        responses['http://foo.com/sitemap%d.xml' % i] = FakeResponse(
+            sitemap(*['http://foo.com/%d' % j for j in xrange(i * 50, i * 50 + 50)]), headers={'content-type': 'text/xml'})
+    crawler = tasks.CrawlerTask(domain, ScrapedItem, engine=engine)
+    crawler.start()
+    assert ScrapedItem.objects.count() == 150
+    assert session.requested.count('http://foo.com/index.xml') == 1
+    assert crawler.metrics.counters['errors.sitemap'] == 1
+
+
+def test_crawl_survives_broken_sitemaps(site):
+    domain, session = site
+    responses = session.responses
+    responses['http://foo.com/robots.txt'].content += 'Sitemap: http://foo.com/down.xml\nSitemap: http://foo.com/cut.xml\n'
+    responses['http://foo.com/down.xml'] = requests.ConnectionError('connection refused')
+    responses['http://foo.com/cut.xml'] = FakeResponse(sitemap('http://foo.com/0'), headers={'content-type': 'text/xml'},
+                                                       error=requests.exceptions.ChunkedEncodingError('connection reset'))
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    crawler.start()
+    assert ScrapedItem.objects.count() == 150
+    assert crawler.metrics.counters['errors.sitemap'] == 2
+    assert crawler.metrics.counters['errors.connection'] == 2
+
+
+def test_crawl_limits_sitemaps(site):
+    domain, session = site
+    responses = session.responses
+    responses['http://foo.com/robots.txt'].content = 'User-agent: *\nSitemap: http://foo.com/index.xml\n'
+    responses['http://foo.com/index.xml'] = FakeResponse(sitemap_index('http://foo.com/nested.xml'), headers={'content-type': 'text/xml'})
+    responses['http://foo.com/nested.xml'] = FakeResponse(sitemap_index('http://foo.com/sitemap.xml'), headers={'content-type': 'text/xml'})
+    CrawlConfig.objects.create(key='SITEMAPDEPTH', value='1')
+    tasks.CrawlerTask(domain, ScrapedItem).start()
+    assert 'http://foo.com/nested.xml' in session.requested
+    assert 'http://foo.com/sitemap.xml' not in session.requested
+    CrawlConfig.objects.create(key='SITEMAPMAX', value='1')
+    del session.requested[:]
+    tasks.CrawlerTask(domain, ScrapedItem).start()
+    assert 'http://foo.com/nested.xml' not in session.requested
+    assert ScrapedItem.objects.count() == 0
+
+
+def test_crawl_resumes_from_checkpoint(site):
+    domain, session = site
+    session.responses['http://foo.com/robots.txt'].content += 'Sitemap: http://foo.com/sitemap2.xml\n'
+    session.responses['http://foo.com/sitemap2.xml'] = FakeResponse(sitemap('http://foo.com/150'), headers={'content-type': 'text/xml'})
+    now = timezone.now()
+    CrawlCheckpoint.objects.create(domain=domain, started=now - timedelta(hours=1), sitemaps='http://foo.com/sitemap2.xml')
+    for i in xrange(100):
+        CrawlPage.objects.create(domain=domain, url='http://foo.com/%d' % i, lastscraped=now - timedelta(minutes=30))
+    crawler = tasks.CrawlerTask(domain, ScrapedItem, force=True)
+    crawler.start()
+    assert 'http://foo.com/sitemap2.xml' not in session.requested
+    assert 'http://foo.com/99' not in session.requested
+    assert ScrapedItem.objects.count() == 50
+    assert not CrawlCheckpoint.objects.exists()
+
+
+def test_crawl_saves_progress_at_time_limit(site):
+    domain, session = site
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    consolidate = crawler.consolidate
+    calls = []
+
+    def interrupted():
+        calls.append(1)
+        if len(calls) == 1:
+            raise SoftTimeLimitExceeded()
+        consolidate()
+    crawler.consolidate = interrupted
+    crawler.start()
+    assert crawler.stopped
+    assert ScrapedItem.objects.count() == 100
+    assert CrawlCheckpoint.objects.filter(domain=domain).exists()
+    # the next crawl only fetches the rest
+    del session.requested[:]
+    tasks.CrawlerTask(domain, ScrapedItem, force=True).start()
+    assert ScrapedItem.objects.count() == 150
+    assert len([url for url in session.requested if 'sitemap' not in url]) == 50
+    assert not CrawlCheckpoint.objects.exists()
+
+
+@pytest.mark.parametrize('engine', [None, ThreadedEngine])
+def test_crawl_stops_on_time_limit_signal(site, engine):
+    domain, session = site
+    get = session.get
+
+    def get_and_signal(url, **kwargs):
+        # celery signals the soft time limit while some download is running
+        if len([u for u in session.requested if 'sitemap' not in u]) == 50:
+            os.kill(os.getpid(), SIG_SOFT_TIMEOUT)
+        return get(url, **kwargs)
+    session.get = get_and_signal
+    previous = signal.getsignal(SIG_SOFT_TIMEOUT)
+    crawler = tasks.CrawlerTask(domain, ScrapedItem, engine=engine() if engine else None)
+    crawler.start()
+    assert signal.getsignal(SIG_SOFT_TIMEOUT) is previous
+    assert crawler.stopped
+    scraped = ScrapedItem.objects.count()
+    assert 0 < scraped < 150
+    assert CrawlCheckpoint.objects.filter(domain=domain).exists()
+    session.get = get
+    tasks.CrawlerTask(domain, ScrapedItem, force=True).start()
+    assert ScrapedItem.objects.count() == 150
+    assert not CrawlCheckpoint.objects.exists()
+
+
+def test_sharded_crawl(site, monkeypatch):
+    domain, session = site
+    domain.shards = 3
+    domain.save()
+    CrawlConfig.objects.create(key='SHARDCHUNK', value='40')
+    CrawlConfig.objects.filter(key='REQUESTRATE').update(value='3000')
+    dispatched = []
+    monkeypatch.setattr(tasks.crawl_shard_task, 'apply_async', lambda args, **kwargs: dispatched.append(args))
+    tasks.crawl_task(domain.pk, 'tests.ScrapedItem')
+    assert dispatched == [(domain.pk, 'tests.ScrapedItem', False)] * 3
+    assert CrawlChunk.objects.filter(domain=domain).count() == 4
+    assert ScrapedItem.objects.count() == 0
+    shard = tasks.ShardTask(domain, ScrapedItem)
+    shard.start()
+    assert shard.throttle.rate_for_domain == 1000
+    assert ScrapedItem.objects.count() == 150
+    assert not CrawlChunk.objects.exclude(status=CrawlChunk.STATUS_TYPES.done).exists()
+    # the other shards find nothing left to do
+    del session.requested[:]
+    tasks.crawl_shard_task(domain.pk, 'tests.ScrapedItem')
+    assert not session.requested
+
+
+def test_crawl_skips_rows_with_same_fingerprint(site, settings):
+    domain, session = site
+    settings.SCREEP_METRICS = 'memory'
+    tasks.CrawlerTask(domain, ScrapedItem).start()
+    # fingerprints cover where the values are stored and the rules they were extracted with
+    scope = ('tests.ScrapedItem', ExtractionPlan({'title': '//title/text()'}).digest)
+    assert CrawlPage.objects.get(url='http://foo.com/7').fingerprint == fingerprint({'title': 'Item 7'}, *scope)
+    # the pages change, but only one of them in a way that changes the extracted values
+    for i in xrange(150):
+        session.responses['http://foo.com/%d' % i].content = page('Item %d' % i).replace('</title>', '</title><meta name="robots" content="noarchive">')
+    session.responses['http://foo.com/7'].content = page('Item seven')
+    crawler = tasks.CrawlerTask(domain, ScrapedItem, force=True)
+    crawler.start()
+    assert crawler.metrics.counters['pages.scraped'] == 150
+    assert crawler.metrics.counters['db.unchanged'] == 149
+    assert ScrapedItem.objects.get(url='http://foo.com/7').title == 'Item seven'
+    assert CrawlPage.objects.get(url='http://foo.com/7').fingerprint == fingerprint({'title': 'Item seven'}, *scope)
+    # rows that went missing are written again
+    ScrapedItem.objects.filter(url__in=['http://foo.com/1', 'http://foo.com/2']).delete()
+    crawler = tasks.CrawlerTask(domain, ScrapedItem, force=True)
+    crawler.start()
+    assert crawler.metrics.counters['db.unchanged'] == 148
+    assert ScrapedItem.objects.count() == 150
+
+
+@pytest.mark.parametrize('engine', [None, ThreadedEngine()], ids=['gevent', 'threaded'])
+def test_crawl_looks_up_pages_in_batches(site, settings, engine):
+    domain, session = site
+    settings.SCREEP_METRICS = 'memory'
+    CrawlConfig.objects.create(key='LOOKUPBATCH', value='7')
+    tasks.CrawlerTask(domain, ScrapedItem).start()
+    # the first 100 urls were not modified since, the others are requested conditionally
+    session.responses['http://foo.com/sitemap.xml'].content = (
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s%s</urlset>' % (
+            ''.join('<url><loc>http://foo.com/%d</loc><lastmod>2000-01-01</lastmod></url>' % i for i in xrange(100)),
+            ''.join('<url><loc>http://foo.com/%d</loc></url>' % i for i in xrange(100, 150))))
+    crawler = tasks.CrawlerTask(domain, ScrapedItem, engine=engine)
+    crawler.start()
+    assert crawler.metrics.counters.get('pages.scraped', 0) == 0
+    assert crawler.metrics.counters['pages.unchanged'] == 50
+    assert crawler.progress.done == set(['http://foo.com/sitemap.xml'])
+
+
+def test_crawl_extracts_again_after_rules_change(site, settings):
+    domain, session = site
+    settings.SCREEP_METRICS = 'memory'
+    tasks.CrawlerTask(domain, ScrapedItem).start()
+    # the same pages are conditional on an incremental crawl, but not on a forced one
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    crawler.start()
+    assert crawler.metrics.counters['pages.unchanged'] == 150
+    crawler = tasks.CrawlerTask(domain, ScrapedItem, force=True)
+    crawler.start()
+    assert crawler.metrics.counters['pages.scraped'] == 150
+    # pages extracted with other rules are not conditional either
+    attribute = DomainAttributes.objects.get(domain=domain, key='title')
+    attribute.xpath = "concat(//title/text(), '!')"
+    attribute.save()
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    crawler.start()
+    assert crawler.metrics.counters['pages.scraped'] == 150
+    assert ScrapedItem.objects.get(url='http://foo.com/42').title == 'Item 42!'
+    assert CrawlPage.objects.get(url='http://foo.com/42').plan == crawler.plan.digest
+
+
+def test_crawl_archives_pages(site, settings, tmpdir):
+    domain, session = site
+    settings.SCREEP_ARCHIVE = str(tmpdir)
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    crawler.start()
+    assert not crawler.head_only
+    assert crawler.archive.get('http://foo.com/42') == (page('Item 42'), None)
+    assert len(list(crawler.archive.latest())) == 150
+
+
+def test_crawl_backs_off_when_overloaded(site, settings):
+    domain, session = site
+    settings.SCREEP_METRICS = 'memory'
+    domain.maxworkers = 8
+    domain.save()
+    for i in xrange(100, 110):
+        session.responses['http://foo.com/%d' % i].status_code = 503
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    crawler.start()
+    assert crawler.limit.maximum == 8
+    assert crawler.metrics.counters['errors.overloaded'] == 10
+    assert crawler.metrics.counters['pages.failed'] == 10
+    assert crawler.metrics.counters['concurrency.decreases'] >= 1
+    assert ScrapedItem.objects.count() == 140
+
+
+def test_crawl_backs_off_when_downloads_are_abandoned(site, settings, monkeypatch):
+    domain, session = site
+    settings.SCREEP_METRICS = 'memory'
+    domain.maxworkers = 8
+    domain.save()
+    get = session.get
+
+    def stalling_get(url, **kwargs):
+        if url in ['http://foo.com/%d' % i for i in xrange(100, 110)]:
+            gevent.sleep(1)
+        return get(url, **kwargs)
+    session.get = stalling_get
+    crawler = tasks.CrawlerTask(domain, ScrapedItem)
+    monkeypatch.setattr(crawler.engine, 'timeout', lambda seconds: gevent.Timeout(0.05, False))
+    crawler.start()
+    assert crawler.metrics.counters['errors.timeout'] == 10
+    assert crawler.metrics.counters['pages.failed'] == 10
+    assert crawler.metrics.counters['concurrency.decreases'] >= 1
+    assert ScrapedItem.objects.count() == 140
+
+
+def test_shard_picks_up_chunks_of_dead_and_late_shards(site, monkeypatch):
+    domain, session = site
+    now = timezone.now()
+    urls = ['http://foo.com/%d' % i for i in xrange(150)]
+    live = CrawlChunk.objects.create(domain=domain, urls='\n'.join(urls[:50]), status=CrawlChunk.STATUS_TYPES.claimed, claimed=now)
+    CrawlChunk.objects.create(domain=domain, urls='\n'.join(urls[50:100]), status=CrawlChunk.STATUS_TYPES.claimed,
+                              claimed=now - timedelta(hours=2))
+    key = CrawlChunk.cache_for_domain(domain.pk)
+    cache.set(key, True)
+    claim_next = CrawlChunk.claim_next.im_func
+    claims = []
+
+    def claim_and_finish_sitemaps(cls, domain, timeout, now=None):
+        chunk = claim_next(cls, domain, timeout, now)
+        claims.append(chunk)
+        if len(claims) == 2:
+            # the last chunk is written and the sitemaps finish right after a failed claim
+            CrawlChunk.objects.create(domain=domain, urls='\n'.join(urls[100:]))
+            cache.delete(key)
+        return chunk
+    monkeypatch.setattr(CrawlChunk, 'claim_next', classmethod(claim_and_finish_sitemaps))
+    shard = tasks.ShardTask(domain, ScrapedItem)
+    engine_sleep = shard.engine.sleep
+    slept = []
+
+    def sleep(seconds):
+        if seconds == 1:
+            slept.append(seconds)
+            live.finish()  # the other shard is done
+        engine_sleep(seconds)
+    monkeypatch.setattr(shard.engine, 'sleep', sleep)
+    shard.start()
+    assert claims[1] is None
+    assert ScrapedItem.objects.count() == 100
+    assert len(slept) == 1
+    assert CrawlChunk.objects.filter(status=CrawlChunk.STATUS_TYPES.done).count() == 3
+
+
+def test_idle_shard_comes_back_when_claims_expire(site, monkeypatch):
+    domain, session = site
+    CrawlConfig.objects.create(key='SHARDTIMEOUT', value='600')
+    CrawlChunk.objects.create(domain=domain, urls='http://foo.com/1', status=CrawlChunk.STATUS_TYPES.claimed,
+                              claimed=timezone.now() - timedelta(seconds=100))
+    dispatched = []
+    monkeypatch.setattr(tasks.crawl_shard_task, 'apply_async', lambda args, **kwargs: dispatched.append((args, kwargs['countdown'])))
+    shard = tasks.ShardTask(domain, ScrapedItem)
+    monkeypatch.setattr(shard.engine, 'sleep', lambda seconds: pytest.fail("an idle shard must not wait"))
+    shard.start()
+    assert dispatched == [((domain.pk, 'tests.ScrapedItem', False), dispatched[0][1])]
+    assert 495 <= dispatched[0][1] <= 501
+    # nothing left to do at all, nothing to come back for
+    CrawlChunk.objects.update(status=CrawlChunk.STATUS_TYPES.done)
+    tasks.ShardTask(domain, ScrapedItem).start()
+    assert len(dispatched) == 1
+
+
+def test_sharded_crawl_keeps_chunks_in_progress(site, monkeypatch):
+    domain, session = site
+    domain.shards = 2
+    domain.save()
+    monkeypatch.setattr(tasks.crawl_shard_task, 'apply_async', lambda args, **kwargs: None)
+    live = CrawlChunk.objects.create(domain=domain, urls='http://foo.com/1', status=CrawlChunk.STATUS_TYPES.claimed,
+                                     claimed=timezone.now())
+    CrawlChunk.objects.create(domain=domain, urls='http://foo.com/2', status=CrawlChunk.STATUS_TYPES.done)
+    tasks.ShardedCrawl(domain, ScrapedItem).start()
+    assert CrawlChunk.objects.filter(pk=live.pk).exists()
+    assert CrawlChunk.objects.filter(domain=domain).count() == 2
+    CrawlChunk.objects.filter(pk=live.pk).delete()
+    live.finish()  # deleted in the meantime, nothing to update
@@ -0,0 +1,67 @@
+# -*-*- encoding: utf-8 -*-*-
+from .. import throttle
+from ..throttle import AdaptiveLimit, HostThrottle, TokenBucket
+
+
+def test_token_bucket(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(throttle, 'time', lambda: now[0])
+    bucket = TokenBucket(2, 2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0.5
+    assert bucket.reserve() == 1.0
+    now[0] += 1.0
+    assert bucket.reserve() == 0.5
+    assert TokenBucket(0).reserve() == 0
+
+
+def test_host_throttle_uses_crawl_delay():
+    t = HostThrottle('foo.com', 10, delay=2)
+    assert t.rate_for_domain == 0.5
+    assert t.bucket_for('http://www.foo.com/a') is t.bucket_for('foo.com/b')
+    assert t.bucket_for('http://static.foo.com/sitemap.xml') is t.bucket_for('http://foo.com/')
+    cdn = t.bucket_for('http://cdn.bar.com/sitemap.xml')
+    assert cdn is not t.bucket_for('http://foo.com/')
+    assert cdn.rate == 10
+
+
+def test_adaptive_limit_grows_and_backs_off():
+    limit = AdaptiveLimit(2, 20)
+    slept = []
+    for i in xrange(2):
+        limit.acquire(slept.append)
+    assert limit.active == 2 and not slept
+    # slow start, one more per successful request
+    for i in xrange(6):
+        limit.release(0.1)
+        limit.acquire(slept.append)
+    assert limit.size == 8
+    limit.release(overloaded=True)
+    assert limit.size == 4 and limit.decreases == 1
+    # requests that were in flight do not halve it again
+    limit.release(overloaded=True)
+    assert limit.size == 4
+    for i in xrange(4):
+        limit.acquire(slept.append)
+        limit.release(0.1)
+    # one more per window after the first decrease
+    assert 4 < limit.limit < 5
+    for i in xrange(40):
+        limit.acquire(slept.append)
+        limit.release(overloaded=True)
+    assert limit.size == 2
+    assert limit.active == 0
+
+
+def test_adaptive_limit_backs_off_when_latency_rises():
+    limit = AdaptiveLimit(1, 100)
+    for latency in [0.1] * AdaptiveLimit.WINDOW + [0.15] * AdaptiveLimit.WINDOW:
+        limit.active += 1
+        limit.release(latency)
+    assert limit.decreases == 0 and limit.size == 41
+    for i in xrange(AdaptiveLimit.WINDOW):
+        limit.active += 1
+        limit.release(0.5)
+    assert limit.decreases == 1
+    assert limit.size == 30
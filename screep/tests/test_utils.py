@@ -0,0 +1,23 @@
+# -*-*- encoding: utf-8 -*-*-
+from datetime import datetime
+from django.utils import timezone
+from ..utils import charset_from_content_type, parse_lastmod
+
+
+def test_parse_lastmod():
+    utc = timezone.utc
+    assert parse_lastmod('2014-11-05') == datetime(2014, 11, 5, tzinfo=utc)
+    assert parse_lastmod('2014-11-05T13:20:00Z') == datetime(2014, 11, 5, 13, 20, tzinfo=utc)
+    assert parse_lastmod(' 2014-11-05T13:20+01:00 ') == datetime(2014, 11, 5, 12, 20, tzinfo=utc)
+    assert parse_lastmod('2014-11-05T13:20:00.123+01:00') == datetime(2014, 11, 5, 12, 20, 0, 123000, tzinfo=utc)
+    assert parse_lastmod('2014') is None
+    assert parse_lastmod('yesterday') is None
+    assert parse_lastmod('') is None
+
+
+def test_charset_from_content_type():
+    assert charset_from_content_type('text/html; charset=UTF-8') == 'utf-8'
+    assert charset_from_content_type('text/html;charset="latin-1"') == 'iso8859-1'
+    assert charset_from_content_type('text/html; charset=bogus') is None
+    assert charset_from_content_type('text/html') is None
+    assert charset_from_content_type(None) is None
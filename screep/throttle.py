@@ -0,0 +1,164 @@
+# -*-*- encoding: utf-8 -*-*-
+import math
+import threading
+import urlparse
+from time import time
+import gevent
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter. Tokens are added at `rate` per second up to `capacity`
+    and every request takes one. A rate of zero or less means no limit. Callers wait
+    with `sleep`, which defaults to gevent.sleep.
+    """
+
+    def __init__(self, rate, capacity=None, sleep=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.timestamp = time()
+        self.sleep = sleep or gevent.sleep
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token and returns the number of seconds to wait before it may be used.
+        Tokens are borrowed from the future if needed, so waiting callers are served in order.
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= 1
+            tokens = self.tokens
+        if tokens >= 0:
+            return 0.0
+        return -tokens / self.rate
+
+    def acquire(self):
+        """
+        Waits until a token is available.
+        """
+        wait = self.reserve()
+        if wait > 0:
+            self.sleep(wait)
+
+
+class HostThrottle(object):
+    """
+    Keeps a token bucket per host. The crawled domain and its subdomains share one bucket,
+    limited by the robots.txt crawl delay if there is one, else by `rate` requests per second.
+    Other hosts, such as a CDN serving the sitemaps, get their own bucket at `rate`.
+    """
+
+    def __init__(self, domain, rate, delay=None, sleep=None):
+        self.domain = self.normalize(domain)
+        self.rate = rate
+        self.sleep = sleep
+        self.buckets = {}
+        if delay:
+            # no bursts, every request waits the full crawl delay
+            self.buckets[self.domain] = TokenBucket(1.0 / delay, 1, sleep)
+        else:
+            self.buckets[self.domain] = TokenBucket(rate, sleep=sleep)
+
+    @staticmethod
+    def normalize(host):
+        host = host.lower().split(':')[0]
+        return host[4:] if host.startswith('www.') else host
+
+    @property
+    def rate_for_domain(self):
+        return self.buckets[self.domain].rate
+
+    def bucket_for(self, url):
+        host = self.normalize(urlparse.urlsplit(url if '://' in url else "http://%s" % url).netloc)
+        if host == self.domain or host.endswith('.' + self.domain):
+            host = self.domain
+        bucket = self.buckets.get(host, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, sleep=self.sleep)
+            self.buckets[host] = bucket
+        return bucket
+
+    def acquire(self, url):
+        """
+        Waits until a request to given url is allowed.
+        """
+        self.bucket_for(url).acquire()
+
+
+class AdaptiveLimit(object):
+    """
+    Limit on the number of concurrent requests to a host that adapts to how well the host
+    copes, by additive increase and multiplicative decrease. Starts at `minimum` and grows by
+    one per successful request until the host first shows signs of overload, then by one per
+    `limit` successful requests. Timeouts, 429 and 503 responses and a p95 latency more than
+    `latency_factor` times the best since the last decrease halve the limit, at most once per
+    `limit` completed requests, as requests already in flight were sent at the old limit.
+    """
+
+    WINDOW = 20  # requests per latency percentile
+
+    def __init__(self, minimum, maximum, latency_factor=2.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.latency_factor = latency_factor
+        self.limit = float(self.minimum)
+        self.active = 0
+        self.slow_start = True
+        self.latencies = []
+        self.baseline = None
+        self.completed = self.maximum  # since the last decrease
+        self.decreases = 0
+        self.lock = threading.Lock()
+
+    @property
+    def size(self):
+        return int(self.limit)
+
+    def acquire(self, sleep, interval=0.01):
+        """
+        Waits with `sleep` until less than `limit` requests are active, then counts one more.
+        """
+        while True:
+            with self.lock:
+                if self.active < self.size:
+                    self.active += 1
+                    return
+            sleep(interval)
+
+    def release(self, latency=None, overloaded=False):
+        """
+        Counts a finished request. Pass the latency of successful requests, and whether
+        the host was overloaded for failed ones.
+        """
+        with self.lock:
+            self.active -= 1
+            self.completed += 1
+            if latency is not None and not overloaded:
+                self.latencies.append(latency)
+                if len(self.latencies) >= AdaptiveLimit.WINDOW:
+                    p95 = sorted(self.latencies)[int(math.ceil(0.95 * len(self.latencies))) - 1]
+                    self.latencies = []
+                    if self.baseline is None or p95 < self.baseline:
+                        self.baseline = p95
+                    elif p95 > self.baseline * self.latency_factor:
+                        overloaded = True
+            if overloaded:
+                self._decrease()
+            elif latency is not None:
+                self.limit = min(self.maximum, self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+
+    def _decrease(self):
+        if self.completed < self.limit:
+            return
+        self.slow_start = False
+        self.limit = max(float(self.minimum), self.limit / 2)
+        self.completed = 0
+        self.decreases += 1
+        self.latencies = []
+        self.baseline = None
@@ -1,4 +1,10 @@
 # -*-*- encoding: utf-8 -*-*-
+import codecs
+import re
+from datetime import datetime
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
 
 def fast_iter(context, func):
@@ -20,3 +26,43 @@ def safe_str(obj):
         return str(obj)
     except UnicodeEncodeError:
         return unicode(obj).encode('utf-8')
+
+
+def parse_lastmod(value):
+    """
+    Parses a W3C datetime as used in a sitemap's <lastmod>. Values without a timezone
+    are taken to be in the default timezone. Returns None if the value cannot be parsed.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        dt = parse_datetime(value)
+        if dt is None:
+            d = parse_date(value)
+            if d is None:
+                return None
+            dt = datetime(d.year, d.month, d.day)
+    except ValueError:
+        return None
+    if settings.USE_TZ and timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.get_default_timezone())
+    elif not settings.USE_TZ and timezone.is_aware(dt):
+        dt = timezone.make_naive(dt, timezone.get_default_timezone())
+    return dt
+
+
+CHARSET_RE = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+
+
+def charset_from_content_type(content_type):
+    """
+    Returns the charset declared in a Content-Type header, or None if there is no known charset.
+    """
+    m = CHARSET_RE.search(content_type or '')
+    if m is None:
+        return None
+    try:
+        return codecs.lookup(m.group(1)).name
+    except LookupError:
+        return None